@@ -1,18 +1,28 @@
 from fasthtml.common import *
 
-from fastlite import *
-
-from prompt_models import (
-    PROMPT_GEN_SYSTEM_PROMPT,
-    PROMPT_GEN_PROMPT,
-    PromptModel,
-    call_llm,
-    call_dummy_llm
+from scheduler import scheduler, QueueFullError
+from events import battle_events, WaitersFull
+from event_log import event_log
+from liveness import liveness
+from metrics import registry, render_seconds
+from leaderboard import leaderboard, GRADE_SCORES
+from archive import archive
+from export import ExportError, export_rows, to_ndjson
+from singleflight import single_flight
+from battles import BATTLE_CONFIG, contender_names, run_flight, save_stage, setup, cancel_battle
+from prompt_models import prewarm
+from storage import (
+    storage,
+    schema_transaction,
+    insert_grade,
+    create_battle,
+    fail_battle,
+    get_battle,
+    battle_outputs,
 )
 
 import os
-import html
-import json
+import functools
 import uuid
 from datetime import datetime
 import logging
@@ -23,19 +33,35 @@ logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 # Set the environment variable before starting the server
-os.environ['WATCHFILES_IGNORE_REGEXES'] = r'.*\.db$ .*\.db-journal$'
+os.environ['WATCHFILES_IGNORE_REGEXES'] = r'.*\.db$ .*\.db-journal$ .*\.db-wal$ .*\.db-shm$'
 
-db = Database('prompt_battle2.db')
+# Uvicorn worker processes; with more than one, reload is off and battle
+# events are shared between workers through the database (see event_log)
+WORKERS = int(os.getenv("WORKERS", 1))
 
-class Generation: 
-    call_id: str;
-    session_id: str;
-    call_type: str;
-    input:str; 
-    output: str; 
-    timestamp: datetime;
+# /sse_output_monitor: comment lines this often keep proxies from closing the
+# connection, and the stream gives up on outputs that take longer than the timeout
+SSE_HEARTBEAT_INTERVAL = float(os.getenv("SSE_HEARTBEAT_INTERVAL", 15))
+SSE_MONITOR_TIMEOUT = float(os.getenv("SSE_MONITOR_TIMEOUT", 300))
+
+# /export hands out every session's battles, so it's off unless a bearer token is configured
+EXPORT_TOKEN = os.getenv("EXPORT_TOKEN")
+
+
+def startup():
+    # Schema setup and client construction happen here rather than at import, so reloads stay fast
+    with schema_transaction():
+        setup()
+        leaderboard.attach(storage)
+        archive.attach(storage)
+        if WORKERS > 1:
+            event_log.attach(storage)
+            battle_events.attach_log(event_log)
+            liveness.attach(storage)
+    # battles whose page was closed mid-generation stop costing LLM calls
+    liveness.on_abandoned(lambda call_id: cancel_battle(call_id, 'abandoned'))
+    prewarm(clients=BATTLE_CONFIG['backend'] == 'openai')
 
-generations_tbl = db.create(Generation, pk='call_id', transform=True)
 
 app, rt = fast_app(
     pico=False, # Disable Pico.css to prevent style conflicts
@@ -43,7 +69,9 @@ app, rt = fast_app(
         Link(rel='stylesheet', href='https://fonts.googleapis.com/css2?family=Poppins:wght@400;600&display=swap'),
         Script(src="https://unpkg.com/htmx.org@1.9.2"),
         Script(src="https://unpkg.com/htmx-ext-sse@2.2.1/sse.js")  # SSE for server-sent events
-    )
+    ),
+    on_startup=[startup, leaderboard.start, liveness.start],
+    on_shutdown=[scheduler.shutdown, leaderboard.stop, liveness.stop, event_log.stop, storage.close],
 )  
 
 style = Style("""
@@ -84,8 +112,15 @@ style = Style("""
         flex-wrap: wrap;
         justify-content: space-between;
     }
-    .output-box {
+    .contender {
         width: 48%;
+    }
+    .contender-label {
+        margin: 0 0 4px 0;
+        font-weight: 600;
+    }
+    .output-box {
+        width: 100%;
         margin-bottom: 10px;
         display: inline-block;
         vertical-align: top;
@@ -146,9 +181,16 @@ style = Style("""
     .btn:hover {
         opacity: 0.5;
     }
+    .leaderboard td, .leaderboard th {
+        padding: 4px 12px;
+        text-align: right;
+    }
+    .leaderboard td:first-child, .leaderboard th:first-child {
+        text-align: left;
+    }
     /* Responsive adjustments */
     @media (max-width: 800px) {
-        .output-box, .buttons {
+        .contender, .output-box, .buttons {
             width: 100%;
             display: block;
         }
@@ -166,13 +208,10 @@ def get():
         Main(
             Div(
                 Div(
-                    create_output_box('output-box1'),
-                    create_output_box('output-box2'),
-                    cls='output-container'
-                ),
-                Div(
-                    create_output_box_with_trigger('output-box3'),
-                    create_output_box_with_trigger('output-box4'),
+                    *[
+                        create_contender_column(number, STAGE_BOXES[prompt_stage], STAGE_BOXES[output_stage])
+                        for number, (prompt_stage, output_stage) in enumerate(CONTENDER_STAGES, start=1)
+                    ],
                     cls='output-container'
                 ),
                 Div(
@@ -210,6 +249,15 @@ def create_submission_form():
         style='margin: 0;'
     )
 
+def create_contender_column(number, prompt_box_id, output_box_id):
+    # Contenders are only shown by number, so graders don't know which is which
+    return Div(
+        P(f"Output {number}", cls='contender-label'),
+        create_output_box(prompt_box_id),
+        create_output_box_with_trigger(output_box_id),
+        cls='contender',
+    )
+
 def create_output_box(box_id):
     return Div(
         Div(id=f'{box_id}-content', cls='output-content'),
@@ -227,15 +275,16 @@ def create_polling_trigger_div():
 def create_grading_buttons():
     return Div(
         Form(
+            Div(render_pair_picker(()), id=PAIR_PICKER),
             Button(
-                "Output 1",
+                "A is better",
                 type="submit",
                 name="grade",
                 value="output-1",
                 cls="btn btn-success mr-2",
             ),
             Button(
-                "Output 2",
+                "B is better",
                 type="submit",
                 name="grade",
                 value="output-2",
@@ -278,22 +327,40 @@ def create_output_box_with_trigger(box_id):
     )
 
 @rt('/grade_output', methods=['POST'])
-def grade_output(grade: str, session):
-    o1_output = session.get('o1_prompt_json', '')
-    challenger_output = session.get('challenger_prompt_json', '')
-
+def grade_output(grade: str, session, a: int = 1, b: int = 2):
+    '''Grade output `a` against output `b` (numbered as on the page) for the session's current battle'''
+    if grade not in GRADE_SCORES:
+        return HTMLResponse(f"Unknown grade {grade!r}", status_code=400)
+    call_id = session.get('call_id')
+    if call_id is None:
+        return Div(
+            P("Submit a task before grading."),
+            cls='grading-thank-you-container',
+        )
+    names = contender_names()
+    if a == b or not (1 <= a <= len(names) and 1 <= b <= len(names)):
+        return Div(P("Pick two different outputs to compare."), cls='grading-thank-you-container')
+    state = battle_events.snapshot(call_id) or load_battle_state(call_id)
+    unfinished = [number for number in (a, b) if f'{names[number - 1]}_output' not in state]
+    if unfinished:
+        return Div(P(f"Output {unfinished[0]} isn't finished yet."), cls='grading-thank-you-container')
+
+    contender_a, contender_b = names[a - 1], names[b - 1]
     grade_entry = {
+        'grade_id': str(uuid.uuid4()),
+        'session_id': session.get('session_id'),
+        'call_id': call_id,
         'grade': grade,
-        'output_1': o1_output,
-        'output_2': challenger_output,
+        'contender_a': contender_a,
+        'contender_b': contender_b,
         'timestamp': datetime.now().isoformat(),
     }
+    insert_grade(grade_entry)
+    leaderboard.record(contender_a, contender_b, grade)
 
-    session.setdefault('latest_grade', {})
-    session['latest_grade'] = grade_entry
-
-    session.setdefault('grade_list', [])
-    session['grade_list'].append(grade_entry)
+    # Older sessions kept every grade in the cookie
+    session.pop('grade_list', None)
+    session.pop('latest_grade', None)
 
     logger.debug(f"Grade received: {grade_entry}")
 
@@ -388,162 +455,357 @@ def get_generations(request):
     if not call_id:
         return HTMLResponse("Missing call_id in get_generations", status_code=400)
     logger.debug(f"get generations called with call_id: {call_id}")
-    return display_generations(call_id)
+    liveness.touch(call_id)
+    return display_generations(
+        call_id,
+        since=request.query_params.get('since'),
+        if_none_match=request.headers.get('if-none-match'),
+    )
 
 
 
-def display_generations(call_id):
-    # check if there is a generation for call_id in the db yet
-    try:
-        logger.debug(f"Trying to get generation: {call_id}-o1_prompt")
-        o1_prompt = generations_tbl[f"{call_id}-o1_prompt"]
-        prompt_gen_complete = True
-    except:
-        prompt_gen_complete = False
+# Each contender has a (prompt, output) pair of stages, and a box for each: the
+# prompt boxes are numbered first, then the output boxes
+CONTENDER_STAGES = tuple((f'{name}_prompt', f'{name}_output') for name in contender_names())
+STAGE_BOXES = {
+    **{prompt_stage: f'output-box{i}' for i, (prompt_stage, _) in enumerate(CONTENDER_STAGES, start=1)},
+    **{output_stage: f'output-box{len(CONTENDER_STAGES) + i}' for i, (_, output_stage) in enumerate(CONTENDER_STAGES, start=1)},
+}
+# Grading form fragment listing the finished outputs that can be compared
+PAIR_PICKER = 'grading-pair'
+
+
+def load_battle_state(call_id):
+    '''Outputs of every finished stage for call_id, in a single primary-key lookup'''
+    # battles past the retention cutoff only exist in the archive
+    battle = get_battle(call_id) or archive.find('battle', call_id)
+    if battle is None:
+        return {}
+    state = {}
+    outputs = battle_outputs(battle)
+    for stage in STAGE_BOXES:
+        if stage in outputs:
+            state[stage] = outputs[stage]
+        elif battle['status'] == 'failed':
+            state[f'{stage}_failed'] = True
+    if battle['status'] == 'cancelled':
+        state['cancelled'] = True
+    return state
+
+
+def is_battle_complete(state):
+    if 'cancelled' in state:
+        return True
+    return all(
+        output_stage in state or f'{output_stage}_failed' in state
+        for _, output_stage in CONTENDER_STAGES
+    )
 
-    try:
-        logger.debug(f"Trying to get final output: {call_id}-o1_output")
-        o1_output_gen = generations_tbl[f"{call_id}-o1_output"]
-        output_gen_complete = True
-    except:
-        output_gen_complete = False
-
-    if output_gen_complete:
-        challenger_output = generations_tbl[f"{call_id}-challenger_output"]
-        
-        o1_output_json = o1_output_gen.output
-        challenger_output_json = challenger_output.output
-
-        logger.debug(f"WE HAVE A GENERATION! Triggering further processing")
-        
-        # Build the content to return as a list of Divs so that both outputs can be returned
-        content = ''.join([
-            # Update output-box3-content with call_id in hx_get
-            Div(
-                P(o1_output_json),
-                id='output-box3-content',
-                cls='output-content',
-                hx_swap='innerHTML',
-                hx_swap_oob='true',
-            ).__html__(),
-            # Update output-box4-content with call_id in hx_get
-            Div(
-                P(challenger_output_json),
-                id='output-box4-content',
-                cls='output-content',
-                hx_swap='innerHTML',
-                hx_swap_oob='true',
-
-            ).__html__(),
-            # Stop polling
-            Div(
-                '',
-                id='generations-polling-trigger',
-                hx_swap='innerHTML', 
-                hx_swap_oob='true',
-                style='display: hidden;',  
-            ).__html__(),
-        ])
-        # Create the response with the HX-Trigger header
-        response = HTMLResponse(content=content + clear_submission_input().__html__())
-        return response
-    
-    elif prompt_gen_complete:
-        o1_prompt_json = o1_prompt.output
 
-        challenger_gen = generations_tbl[f"{call_id}-challenger_prompt"]
-        challenger_prompt_json = challenger_gen.output
+@functools.lru_cache(maxsize=2048)
+def render_box_content(box_id, text):
+    return Div(
+        P(text),
+        id=f'{box_id}-content',
+        cls='output-content',
+        hx_swap='innerHTML',  # just update the content, not the entire box
+        hx_swap_oob='true',
+    ).__html__()
+
 
-        logger.debug(f"WE HAVE A GENERATION! Triggering further processing")
-        
-        # Build the content to return as a list of Divs so that both outputs can be returned
-        content = ''.join([
-            Div(
-                P(o1_prompt_json),
-                id='output-box1-content',
-                hx_swap_oob='true',
-            ).__html__(),
-            Div(
-                P(challenger_prompt_json),
-                id='output-box2-content',
-                hx_swap_oob='true',
-            ).__html__(),
-            # Update output-box3-content with call_id in hx_get
-            Div(
-                P("Generating..."),
-                id='output-box3-content',
-                cls='output-content',
-                hx_swap='innerHTML',
-                hx_swap_oob='true',
-            ).__html__(),
-            # Update output-box4-content with call_id in hx_get
-            Div(
-                P("Generating..."),
-                id='output-box4-content',
-                cls='output-content',
-                hx_swap='innerHTML',
-                hx_swap_oob='true',
-
-            ).__html__(),
-            # polling route for final outputs
-            Div(
-                '',
-                id='generations-polling-trigger',
-                hx_trigger='every 500ms',
-                hx_get=f"/check_generations?call_id={call_id}",
-                hx_swap='innerHTML', 
-                hx_swap_oob='true',
-                style='display: hidden;',  
-            ).__html__(),
-        ])
-        # Create the response with the HX-Trigger header
-        response = HTMLResponse(content=content + clear_submission_input().__html__())
-        return response
-    
+def render_streaming_box_content(box_id, text):
+    # The inner P gets an id so streamed chunks can be appended to it
+    return Div(
+        P(text, id=f'{box_id}-stream'),
+        id=f'{box_id}-content',
+        cls='output-content',
+        hx_swap='innerHTML',
+        hx_swap_oob='true',
+    ).__html__()
+
+
+def render_stream_append(box_id, text):
+    return Span(text, hx_swap_oob=f'beforeend:#{box_id}-stream').__html__()
+
+
+def battle_boxes(call_id, state):
+    '''
+    {box_id: (code, text)} for every output box given the stages finished so far,
+    then the pair picker with the numbers of the finished outputs as its text.
+    The code is a short tag for what the box shows: d(one), f(ailed),
+    p(artial stream), g(enerating), q<position>-<size>, w(aiting) or
+    c(ancelled); the picker's is k followed by the finished outputs. It
+    changes whenever the box's text does, except while a box streams: a 'p'
+    box keeps its code as its text grows, the growth reaching the page as
+    /battle_events appends instead.
+    '''
+    queue_position = scheduler.queue_position(call_id)
+    if 'cancelled' in state:
+        prompt_placeholder = output_placeholder = ('c', "Cancelled")
+    elif queue_position is not None:
+        queued_code = f'q{queue_position}-{scheduler.queue_size}'
+        prompt_placeholder = (queued_code, "Waiting for a free worker...")
+        output_placeholder = (queued_code, f"Queued... position {queue_position} of {scheduler.queue_size}")
     else:
-        content = ''.join([
-            Div(
-                P("Generating..."),
-                id='output-box1-content',
-                # hx_get=f"/generations?call_id={call_id}",
-                hx_swap='innerHTML',  # just update the content, not the entire box
-                hx_swap_oob='true',
-                # hx_trigger='every 200ms',
-            ).__html__(), 
-            Div(
-                P("Generating..."),
-                id='output-box2-content',
-                hx_swap='innerHTML', 
-                hx_swap_oob='true',
-            ).__html__(),
-            Div(
-                P("Queued..."),
-                id='output-box3-content',
-                hx_swap='innerHTML',  # just update the content, not the entire box
-                hx_swap_oob='true',
-            ).__html__(), 
-            Div(
-                P("Queued..."),
-                id='output-box4-content',
-                hx_swap='innerHTML', 
-                hx_swap_oob='true',
-            ).__html__(),
-            # Hidden element with the polling trigger
-            Div(
-                '',
-                id='generations-polling-trigger',
-                hx_trigger='every 500ms',
-                hx_get=f"/generations?call_id={call_id}",
-                hx_swap='innerHTML', 
-                hx_swap_oob='true',
-                style='display: hidden;',  
-            ).__html__(),
-        ])
-
-        # Create the response with the HX-Trigger header
-        response = HTMLResponse(content=content + clear_submission_input().__html__())
-        logger.debug(f"response: {response}")
-        return response
+        prompt_placeholder = ('g', "Generating...")
+        output_placeholder = ('w', "Queued...")
+
+    boxes = {}
+    for prompt_stage, output_stage in CONTENDER_STAGES:
+        if prompt_stage in state:
+            boxes[STAGE_BOXES[prompt_stage]] = ('d', state[prompt_stage])
+        elif f'{prompt_stage}_failed' in state:
+            boxes[STAGE_BOXES[prompt_stage]] = ('f', "Generation failed")
+        else:
+            boxes[STAGE_BOXES[prompt_stage]] = prompt_placeholder
+
+        if f'{output_stage}_failed' in state:
+            boxes[STAGE_BOXES[output_stage]] = ('f', "Generation failed")
+        elif output_stage in state:
+            boxes[STAGE_BOXES[output_stage]] = ('d', state[output_stage])
+        elif f'{output_stage}_partial' in state:
+            boxes[STAGE_BOXES[output_stage]] = ('p', state[f'{output_stage}_partial'])
+        elif prompt_stage in state and 'cancelled' not in state:
+            boxes[STAGE_BOXES[output_stage]] = ('g', "Generating...")
+        else:
+            boxes[STAGE_BOXES[output_stage]] = output_placeholder
+    boxes = {box_id: boxes[box_id] for box_id in STAGE_BOXES.values()}
+
+    finished = tuple(
+        number for number, (_, output_stage) in enumerate(CONTENDER_STAGES, start=1) if output_stage in state
+    )
+    boxes[PAIR_PICKER] = ('k' + '-'.join(map(str, finished)), finished)
+    return boxes
+
+
+def battle_etag(boxes):
+    return '.'.join(code for code, _ in boxes.values())
+
+
+def render_boxes(boxes, since=None):
+    '''OOB swaps for the boxes whose code differs from the `since` etag (all of them without one)'''
+    previous = since.split('.') if since else []
+    content = []
+    for i, (box_id, (code, text)) in enumerate(boxes.items()):
+        if i < len(previous) and previous[i] == code:
+            continue
+        if box_id == PAIR_PICKER:
+            content.append(render_pair_picker_swap(text))
+        elif code == 'p':
+            content.append(render_streaming_box_content(box_id, text))
+        else:
+            content.append(render_box_content(box_id, text))
+    return ''.join(content)
+
+
+def render_pair_picker(finished):
+    '''Choice of the two finished outputs to grade against each other, by number'''
+    if len(finished) < 2:
+        return P("Grading opens once two outputs are finished.")
+
+    def select(name, selected):
+        return Select(
+            *[Option(f"Output {number}", value=str(number), selected=number == selected) for number in finished],
+            name=name,
+        )
+    return Span("A: ", select('a', finished[0]), " B: ", select('b', finished[1]), " ")
+
+
+@functools.lru_cache(maxsize=256)
+def render_pair_picker_swap(finished):
+    return Div(render_pair_picker(finished), id=PAIR_PICKER, hx_swap_oob='true').__html__()
+
+
+def render_battle_state(call_id, state):
+    '''OOB swaps for every output box given the stages finished so far'''
+    return render_boxes(battle_boxes(call_id, state))
+
+
+def polling_trigger(call_id=None, since=None):
+    '''
+    Hidden poller for /check_generations, or a plain div to stop polling when call_id is None.
+    `since` is the etag of what the page now shows, so unchanged polls can be answered with a 204.
+    '''
+    if call_id is None:
+        return Div('', id='generations-polling-trigger', hx_swap_oob='true', style='display: none;').__html__()
+    return Div(
+        '',
+        id='generations-polling-trigger',
+        hx_trigger='every 500ms',
+        hx_get=f"/check_generations?call_id={call_id}" + (f"&since={since}" if since else ""),
+        hx_swap='innerHTML', 
+        hx_swap_oob='true',
+        style='display: none;',  
+    ).__html__()
+
+
+def sse_trigger(call_id):
+    '''Hidden element holding the SSE connection; pushed updates are OOB swaps for the output boxes'''
+    return Div(
+        '',
+        id='generations-polling-trigger',
+        hx_ext='sse',
+        sse_connect=f"/battle_events?call_id={call_id}",
+        sse_swap='battle_update',
+        hx_swap='innerHTML',
+        hx_swap_oob='true',
+        style='display: none;',
+    ).__html__()
+
+
+def display_generations(call_id, since=None, if_none_match=None):
+    '''
+    Polling fallback: current state of the battle from the db. Only boxes that
+    changed since the client's last poll are sent; if nothing changed the answer
+    is an empty 304 (browser revalidation) or 204 (htmx poll carrying `since`).
+    '''
+    state = load_battle_state(call_id)
+    boxes = battle_boxes(call_id, state)
+    etag = battle_etag(boxes)
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'}
+    if if_none_match == f'"{etag}"':
+        return Response(status_code=304, headers=headers)
+    if since == etag:
+        return Response(status_code=204, headers=headers)
+
+    with render_seconds.time(view='poll'):
+        if is_battle_complete(state):
+            logger.debug(f"Battle {call_id} complete, stopping polling")
+            liveness.forget(call_id)
+            trigger = polling_trigger()
+        else:
+            trigger = polling_trigger(call_id, since=etag)
+        content = render_boxes(boxes, since) + trigger
+        if since is None:
+            content += clear_submission_input().__html__()
+    return HTMLResponse(content=content, headers=headers)
+
+
+def display_battle_stream(call_id):
+    '''Initial render after a submission, subscribing the page to pushed updates'''
+    state = battle_events.snapshot(call_id) or load_battle_state(call_id)
+    content = render_battle_state(call_id, state) + sse_trigger(call_id)
+    return HTMLResponse(content=content + clear_submission_input().__html__())
+
+
+@rt('/battle_events')
+async def battle_events_stream(call_id: str):
+    '''
+    Push the output boxes as each stage finishes, without reading the db.
+    Streamed outputs arrive as growing `<stage>_partial` payloads; once the
+    client has a box's stream element only the new text is sent and appended.
+    '''
+    async def event_generator():
+        queue = battle_events.subscribe(call_id)
+        liveness.connect(call_id)
+        try:
+            # the db has it if the events are gone (or the battle ran before a restart)
+            state = battle_events.snapshot(call_id) or load_battle_state(call_id)
+            shown = None  # etag of what the client currently shows
+            while True:
+                with render_seconds.time(view='sse'):
+                    boxes = battle_boxes(call_id, state)
+                    content = render_boxes(boxes, since=shown)
+                shown = battle_etag(boxes)
+                if is_battle_complete(state):
+                    liveness.forget(call_id)
+                    yield sse_message(content + polling_trigger(), event='battle_update')
+                    break
+                if content:
+                    yield sse_message(content, event='battle_update')
+                # partial text the client already shows, per output stage
+                sent = {stage: text for stage, text in state.items() if stage.endswith('_partial')}
+                while True:
+                    try:
+                        stage, payload = await asyncio.wait_for(queue.get(), liveness.heartbeat_interval)
+                    except asyncio.TimeoutError:
+                        # a comment line: keeps the battle alive, and finds out if the client has gone
+                        liveness.touch(call_id)
+                        yield ": keepalive\n\n"
+                        continue
+                    state[stage] = payload
+                    if stage not in sent:
+                        break
+                    output_stage = stage.removesuffix('_partial')
+                    new_text = payload[len(sent[stage]):]
+                    sent[stage] = payload
+                    if new_text:
+                        yield sse_message(render_stream_append(STAGE_BOXES[output_stage], new_text), event='battle_update')
+        finally:
+            liveness.disconnect(call_id)
+            battle_events.unsubscribe(call_id, queue)
+    return EventStream(event_generator())
+
+
+@functools.lru_cache(maxsize=4)
+def render_leaderboard(fitted_at, grades_seen):
+    '''Page body for one (fit, grade count) version, so repeat views don't re-render'''
+    fit = leaderboard.fit
+    if fit is None:
+        bradley_terry = (P("No grades fitted yet."),)
+    else:
+        bradley_terry = Table(
+            Tr(Th("Contender"), Th("Rating"), Th("95% CI"), Th("Games"), Th("Win rate")),
+            *(Tr(
+                Td(row['contender']),
+                Td(f"{row['rating']:.0f}"),
+                Td(f"{row['ci_low']:.0f} – {row['ci_high']:.0f}"),
+                Td(row['games']),
+                Td(f"{row['wins'] / row['games']:.0%}" if row['games'] else "–"),
+            ) for row in fit['rows']),
+            cls='leaderboard',
+        ), P(f"Fitted {fitted_at}, with bootstrap 95% confidence intervals.")
+    elo = Table(
+        Tr(Th("Contender"), Th("Elo"), Th("Games")),
+        *(Tr(Td(row['contender']), Td(f"{row['elo']:.0f}"), Td(row['games'])) for row in leaderboard.elo_table()),
+        cls='leaderboard',
+    )
+    return Main(
+        H2("Bradley-Terry"),
+        *bradley_terry,
+        H2("Live Elo"),
+        elo,
+        P(f"{grades_seen} grades."),
+    )
+
+
+@rt('/leaderboard')
+def get_leaderboard():
+    fitted_at = leaderboard.fit['fitted_at'] if leaderboard.fit else None
+    return Titled("Prompt Battle Leaderboard", style, render_leaderboard(fitted_at, leaderboard.grades_seen))
+
+
+@rt('/metrics')
+def get_metrics():
+    '''Prometheus scrape endpoint; metrics are only aggregated into text here'''
+    return Response(registry.render(), media_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@rt('/export')
+def get_export(request, session_id: str = None, call_type: str = None, since: str = None, until: str = None,
+               cursor: str = None, limit: int = None):
+    '''Generations with their grades as NDJSON; see export.py'''
+    if not EXPORT_TOKEN:
+        return Response("Not found", status_code=404)
+    if request.headers.get('authorization') != f"Bearer {EXPORT_TOKEN}":
+        return Response("Unauthorized", status_code=401, headers={'WWW-Authenticate': 'Bearer'})
+    try:
+        rows = export_rows(storage, session_id=session_id, call_type=call_type,
+                           since=since, until=until, cursor=cursor, limit=limit)
+    except ExportError as e:
+        return Response(str(e), status_code=400)
+    # a sync iterator, so starlette pulls it on threadpool threads and the event loop never blocks on a page
+    return StreamingResponse(to_ndjson(rows), media_type='application/x-ndjson')
+
+
+def publish_queue_positions(started_call_id):
+    # Everyone still waiting moved up a place
+    battle_events.publish(started_call_id, 'started')
+    for call_id in scheduler.pending_call_ids():
+        battle_events.publish(call_id, 'queue_moved')
+
+scheduler.add_listener(publish_queue_positions)
+
     
 # def test_return(id):
 #     content = ''.join([
@@ -563,55 +825,6 @@ def display_generations(call_id):
 
 
 
-@threaded
-def generate_candidate_prompts(user_input: str, session, call_id: str):
-# async def generate_candidate_prompts(user_input: str, session, call_id: str):
-    
-    logger.debug(f"Getting first outputs for: {user_input}")
-    o1_prompt = call_dummy_llm(
-        user_prompt=user_input,
-        model_name="gpt-4o-mini",
-        response_model=PromptModel,
-        sleep_time=2
-    )
-    o1_prompt_json = o1_prompt.model_dump_json()
-    o1_prompt_json = o1_prompt.user_prompt
-    logger.debug(f"o1_prompt_json: {o1_prompt_json}")
-
-    challenger_prompt = call_dummy_llm(
-        system_prompt=PROMPT_GEN_SYSTEM_PROMPT,
-        user_prompt=user_input,
-        model_name="gpt-4o-mini",
-        response_model=PromptModel
-    )
-    challenger_prompt_json = challenger_prompt.model_dump_json()
-    challenger_prompt_json = challenger_prompt.user_prompt
-    logger.debug(f"challenger_prompt_json: {challenger_prompt_json}")
-
-    # insert the generation into the database
-    session_id = session.get("session_id")
-
-    logger.debug(f"Inserting generation into database: {call_id}-o1_prompt:\n{o1_prompt_json}")
-    generations_tbl.insert(Generation(
-        call_id=call_id + '-o1_prompt',
-        session_id=session_id,
-        call_type='o1_prompt',
-        input=user_input, 
-        output=o1_prompt_json, 
-        timestamp=datetime.now().isoformat()
-    ))
-
-    logger.debug(f"Inserting generation into database: {call_id}-challenger_prompt:\n{challenger_prompt_json}")
-    generations_tbl.insert(Generation(
-        call_id=call_id + '-challenger_prompt',
-        session_id=session_id,
-        call_type='challenger_prompt',
-        input=user_input, 
-        output=challenger_prompt_json, 
-        timestamp=datetime.now().isoformat()
-    ))
-    return o1_prompt_json, challenger_prompt_json
-
 def clear_submission_input():
     # Create a new empty input field to clear the existing one
     return Input(
@@ -622,42 +835,60 @@ def clear_submission_input():
         hx_swap_oob='true'      # Perform out-of-band swap
     )
 
-# async def run_generation_pipeline(user_input: str, session, call_id: str):
-    
-#     o1_prompt_json, challenger_prompt_json = await generate_candidate_prompts(user_input, session, call_id)
-    
-#     o1_output, challenger_output = await process_additional_outputs(o1_prompt_json, challenger_prompt_json, session, call_id)
-    
-#    # Store outputs using 'call_id' as the key
-#     logger.debug(f"Storing outputs for call_id: {call_id} in the session variable")
-#     session['outputs'][call_id] = {
-#         'o1_output': o1_output,
-#         'challenger_output': challenger_output
-#     }
-
-#     logger.debug(f"Session updated, session: {session}")
-
-#     return o1_output, challenger_output
-
+# SSE endpoint for a single output (o1_output, challenger_output, ...)
+@rt('/sse_output_monitor/{output_name}')
+async def sse_output(call_id: str, output_name: str):
+    '''
+    Send one output box's final text once it's ready. The connection waits on
+    the battle's event for that stage rather than polling, sends heartbeat
+    comments while it waits, and gives up after SSE_MONITOR_TIMEOUT.
+    '''
+    if output_name not in STAGE_BOXES:
+        return Response(f"Unknown output {output_name}", status_code=404)
+    if battle_events.waiters_full:
+        return Response("Too many open connections, please try again shortly", status_code=503, headers={'Retry-After': '5'})
 
+    def message(text):
+        return sse_message(P(text), event=f'{output_name}_event')
 
-# SSE endpoint for o1_output
-@rt('/sse_output_monitor/{output_name}')
-async def sse_output(session, call_id: str, output_name: str):
     async def output_generator():
-        while True:
-            logger.debug(f"In SSE monitor for {output_name}, call_id: {call_id}, session: {session}")
-            outputs = session.get('outputs', {}).get(call_id, {})
-            logger.debug(f"In SSE monitor searching for {output_name} in outputs: {outputs}")
-            if output_name in outputs:
-                logger.debug(f"Sending SSE message for {output_name}: {outputs[output_name]}")
-                yield sse_message(P(outputs[output_name]), event=f'{output_name}_event')
-                # Clean up after sending
-                del session['outputs'][call_id][output_name]
-                if not session['outputs'][call_id]:
-                    del session['outputs'][call_id]
-                break
-            await asyncio.sleep(5)  # TODO drop sleep time again
+        liveness.connect(call_id)
+        try:
+            # waiting before looking at the state, so an output landing in between isn't missed
+            with battle_events.waiting_for(call_id, output_name) as finished:
+                state = battle_events.snapshot(call_id) or load_battle_state(call_id)
+                if output_name in state:
+                    yield message(state[output_name])
+                    return
+                if f'{output_name}_failed' in state or 'cancelled' in state:
+                    yield message("Generation failed" if 'cancelled' not in state else "Cancelled")
+                    return
+
+                loop = asyncio.get_running_loop()
+                deadline = loop.time() + SSE_MONITOR_TIMEOUT
+                while not finished.done():
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        logger.debug(f"SSE monitor for {output_name}, call_id: {call_id} timed out")
+                        yield message("Timed out waiting for the output")
+                        return
+                    try:
+                        # shielded: the future is shared with the other connections waiting on it
+                        await asyncio.wait_for(asyncio.shield(finished), min(SSE_HEARTBEAT_INTERVAL, remaining))
+                    except asyncio.TimeoutError:
+                        liveness.touch(call_id)
+                        yield ": heartbeat\n\n"
+
+                stage, payload = finished.result()
+                logger.debug(f"Sending SSE message for {output_name}, call_id: {call_id}")
+                if stage == output_name:
+                    yield message(payload)
+                else:
+                    yield message("Cancelled" if stage == 'cancelled' else "Generation failed")
+        except WaitersFull:
+            yield message("Too many open connections, please try again shortly")
+        finally:
+            liveness.disconnect(call_id)
     return EventStream(output_generator())
 
 
@@ -710,15 +941,38 @@ async def sse_output(session, call_id: str, output_name: str):
 async def output(user_input: str, session):
     '''
     This is the first call to get the candidate prompts.
-    Candidate prompts are generated in a different thread, in the 
+    The battle pipeline runs on a scheduler worker, in the 
     meantime we display a loading message.
     '''
     call_id = str(uuid.uuid4())
-    # Initialize 'outputs' in session if it doesn't exist, we'll listen for updates to this dict in the frontend
-    if 'outputs' in session:
-        del session['outputs']
-    session.setdefault(f'outputs', {})
-    generate_candidate_prompts(user_input, session, call_id)
+    session.setdefault('session_id', str(uuid.uuid4()))
+    # The session's previous battle is superseded: nobody is going to look at it any more
+    previous_call_id = session.get('call_id')
+    if previous_call_id:
+        cancel_battle(previous_call_id, 'superseded')
+        liveness.forget(previous_call_id)
+    # The session only references the current battle, grades look it up by call_id
+    session['call_id'] = call_id
+    create_battle(call_id, session['session_id'], user_input, contender_names())
+    # Battle state lives in the db and the event stream, not the cookie, so any worker can serve it
+    session.pop('outputs', None)
+    flight_key = single_flight.make_key(user_input, BATTLE_CONFIG)
+    flight, is_leader = single_flight.join(flight_key, call_id, session['session_id'])
+    liveness.watch(call_id)
+    if not is_leader:
+        # Identical battle already running: catch up on what it has finished, the rest is fanned out to us
+        for stage, (stage_input, stage_output) in flight.completed.items():
+            save_stage(call_id, session['session_id'], stage, stage_input, stage_output)
+        return display_battle_stream(call_id)
+
+    try:
+        scheduler.submit(call_id, run_flight, flight_key, user_input, session['session_id'], call_id)
+    except QueueFullError:
+        liveness.forget(call_id)
+        single_flight.finish(flight_key)
+        fail_battle(call_id)
+        logger.warning(f"Generation queue full, rejecting call_id: {call_id}")
+        return Response("Too many battles in progress, please try again shortly", status_code=503, headers={'Retry-After': '5'})
 
     # o1_output, challenger_output = asyncio.run(run_generation_pipeline(user_input, session, call_id))
     # logger.debug(f"finished run_generation_pipeline for call_id: {call_id}, o1_output: {o1_output}, challenger_output: {challenger_output}")
@@ -726,85 +980,15 @@ async def output(user_input: str, session):
     # asyncio.create_task(run_generation_pipeline(user_input, session, call_id))
     
     # TODO: move clearing the submission form to here?
-    return display_generations(call_id)
+    return display_battle_stream(call_id)
     # return simple_generation_preview(call_id)
 
-@rt('/process_additional_outputs', methods=['GET'])
-def get(request):
-# async def process_additional_outputs(o1_prompt_json, challenger_prompt_json, session, call_id):
-    logger.debug(f"Processing additional outputs")
-    # o1_prompt_json = session.get('o1_prompt_json', '')
-    # challenger_prompt_json = session.get('challenger_prompt_json', '')
-    # data = request.json()
-    data = request.query_params
-    box_id = data.get('box_id')
-    prompt = data.get('prompt')
-    call_id = data.get('call_id')
-
-    # prompt = generations_tbl[f"{call_id}-{output_type}"]
-    # prompt_json = prompt.output
-
-    # Simulate processing delay
-    import time
-    time.sleep(0.1)  # Simulate delay
-
-    logger.debug(f"Getting final outputs for: {user_input}")
-    o1_prompt = call_dummy_llm(
-        user_prompt=user_input,
-        model_name="gpt-4o-mini",
-        response_model=PromptModel,
-        sleep_time=2
-    )
-    o1_prompt_json = o1_prompt.model_dump_json()
-    o1_prompt_json = o1_prompt.user_prompt
-    logger.debug(f"o1_prompt_json: {o1_prompt_json}")
-
-    challenger_prompt = call_dummy_llm(
-        system_prompt=PROMPT_GEN_SYSTEM_PROMPT,
-        user_prompt=user_input,
-        model_name="gpt-4o-mini",
-        response_model=PromptModel
-    )
-    challenger_prompt_json = challenger_prompt.model_dump_json()
-    challenger_prompt_json = challenger_prompt.user_prompt
-    logger.debug(f"challenger_prompt_json: {challenger_prompt_json}")
-
-    # insert the generation into the database
-    session_id = session.get("session_id")
-
-    logger.debug(f"Inserting generation into database: {call_id}-o1_prompt:\n{o1_prompt_json}")
-    generations_tbl.insert(Generation(
-        call_id=call_id + '-o1_prompt',
-        session_id=session_id,
-        call_type='o1_prompt',
-        input=user_input, 
-        output=o1_prompt_json, 
-        timestamp=datetime.now().isoformat()
-    ))
-
-    logger.debug(f"Inserting generation into database: {call_id}-challenger_prompt:\n{challenger_prompt_json}")
-    generations_tbl.insert(Generation(
-        call_id=call_id + '-challenger_prompt',
-        session_id=session_id,
-        call_type='challenger_prompt',
-        input=user_input, 
-        output=challenger_prompt_json, 
-        timestamp=datetime.now().isoformat()
-    ))
-    return o1_prompt_json, challenger_prompt_json
-
-    # Process outputs based on `box_id`
-    output_content = prompt.upper()
-
-    # return output_content1, output_content2
-    return Div(
-        P(output_content),
-        id=f'{box_id}-content',
-    )
-
-serve(
-    reload=True,
-    reload_excludes=['*.db', '*.db-journal'],
-    host='0.0.0.0',
-    port=5001
-    )
\ No newline at end of file
+if WORKERS > 1:
+    serve(reload=False, workers=WORKERS, host='0.0.0.0', port=5001)
+else:
+    serve(
+        reload=True,
+        reload_excludes=['*.db', '*.db-journal', '*.db-wal', '*.db-shm'],
+        host='0.0.0.0',
+        port=5001
+        )
\ No newline at end of file
@@ -0,0 +1,278 @@
+'''
+Retention job: move generations, grades and battles older than a cutoff out
+of the live database into date-partitioned, compressed JSONL files, then
+VACUUM the database so the working set /check_generations reads stays small.
+
+    python archive.py --older-than-days 30 --dir archive
+
+Rows land in <dir>/<table>/date=YYYY-MM-DD/part-<run>-<chunk>.jsonl.zst
+(zstandard when it's installed, .jsonl.gz otherwise). The archive_part table
+keeps one row per file, with its key range and a Bloom filter of its keys, so
+a battle can still be looked up by call_id after it's gone from the live
+tables without the index growing per row, and the leaderboard still counts
+archived grades. Each chunk's file is written and synced before its rows are
+deleted; if a run dies in between, the next run archives those rows again and
+readers skip the duplicates.
+'''
+import io
+import os
+import sys
+import gzip
+import json
+import time
+import uuid
+import hashlib
+import logging
+import functools
+import argparse
+import importlib.util
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+# table -> (primary key, timestamp the cutoff applies to)
+ARCHIVED_TABLES = {
+    'generation': ('call_id', 'timestamp'),
+    'grade': ('grade_id', 'timestamp'),
+    'battle': ('battle_id', 'created_at'),
+}
+
+
+# decoded part files kept in memory for repeated lookups
+PART_CACHE_SIZE = int(os.getenv("ARCHIVE_PART_CACHE_SIZE", 4))
+
+
+class ArchivePart:
+    path: str
+    tbl: str
+    rows: int
+    min_key: str
+    max_key: str
+    key_filter: bytes
+    archived_at: str
+
+
+class KeyFilter:
+    '''Bloom filter over a part's keys: a key it doesn't contain is certainly not in the part'''
+    hashes = 7
+
+    def __init__(self, bits: bytes):
+        self.bits = bits
+
+    @classmethod
+    def build(cls, keys, bits_per_key: int = 10):
+        # 10 bits and 7 hashes per key is about a 1% false positive rate
+        bits = bytearray(max(1, len(keys) * bits_per_key // 8))
+        for key in keys:
+            for i in cls._positions(key, len(bits) * 8):
+                bits[i >> 3] |= 1 << (i & 7)
+        return cls(bytes(bits))
+
+    @classmethod
+    def _positions(cls, key: str, size: int):
+        digest = hashlib.blake2b(str(key).encode(), digest_size=16).digest()
+        a, b = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return ((a + i * b) % size for i in range(cls.hashes))
+
+    def __contains__(self, key: str):
+        return all(self.bits[i >> 3] & (1 << (i & 7)) for i in self._positions(key, len(self.bits) * 8))
+
+
+class Archive:
+    '''Compressed JSONL partitions under `directory`, indexed per part file in the database'''
+    def __init__(self, directory: str = 'archive', chunk_size: int = 20_000):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.storage = None
+        self._filters = {}  # part path -> KeyFilter; parts never change once written
+
+    def attach(self, storage):
+        self.storage = storage
+        self.tbl = storage.db.create(ArchivePart, pk='path', transform=True)
+        self.tbl.create_index(['tbl', 'min_key', 'max_key'], if_not_exists=True)
+
+    def parts(self, table: str):
+        '''Part files of table relative to the archive directory, oldest partition first'''
+        root = os.path.join(self.directory, table)
+        if not os.path.isdir(root):
+            return []
+        return [
+            os.path.join(table, partition, name)
+            for partition in sorted(os.listdir(root))
+            for name in sorted(os.listdir(os.path.join(root, partition)))
+            if name.endswith(('.jsonl.zst', '.jsonl.gz'))
+        ]
+
+    def rows(self, table: str):
+        '''Every archived row of table, oldest partition first'''
+        pk, _ = ARCHIVED_TABLES[table]
+        seen = set()
+        for part in self.parts(table):
+            for row in _read_part(os.path.join(self.directory, part)):
+                if row[pk] not in seen:
+                    seen.add(row[pk])
+                    yield row
+
+    def find(self, table: str, key: str):
+        '''The archived row of table with primary key `key`, or None'''
+        if self.storage is None:
+            return None
+        pk, _ = ARCHIVED_TABLES[table]
+        candidates = self.storage.reader.q(
+            f"SELECT path FROM {self.tbl.name} WHERE tbl = ? AND min_key <= ? AND max_key >= ? ORDER BY path DESC",
+            [table, key, key],
+        )
+        # the key filters rule out nearly every part, so ids that were never archived don't open any file
+        for candidate in candidates:
+            if key in self._filter(candidate['path']):
+                row = _part_rows(os.path.join(self.directory, candidate['path']), pk).get(key)
+                if row is not None:
+                    return row
+        return None
+
+    def _filter(self, path: str):
+        key_filter = self._filters.get(path)
+        if key_filter is None:
+            rows = self.storage.reader.q(f"SELECT key_filter FROM {self.tbl.name} WHERE path = ?", [path])
+            key_filter = self._filters[path] = KeyFilter(rows[0]['key_filter'])
+        return key_filter
+
+    @staticmethod
+    def _part_row(table: str, path: str, keys):
+        return dict(path=path, tbl=table, rows=len(keys), min_key=min(keys, default=''), max_key=max(keys, default=''),
+                    key_filter=KeyFilter.build(keys).bits, archived_at=datetime.now().isoformat())
+
+    def run(self, cutoff: str, tables=tuple(ARCHIVED_TABLES)):
+        '''Archive rows of `tables` older than `cutoff` (an ISO timestamp); returns {table: rows archived}'''
+        run_id = f"{datetime.now():%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:6]}"
+        counts = {}
+        for table in tables:
+            counts[table] = self._archive_table(table, cutoff, run_id)
+        return counts
+
+    def _archive_table(self, table: str, cutoff: str, run_id: str):
+        pk, timestamp = ARCHIVED_TABLES[table]
+        suffix = '.jsonl.zst' if importlib.util.find_spec('zstandard') else '.jsonl.gz'
+        archived, last_key, chunk = 0, '', 0
+        while True:
+            # keyset over the primary key, so each chunk is one index range scan
+            rows = self.storage.reader.q(
+                f"SELECT * FROM {table} WHERE {pk} > ? AND {timestamp} < ? ORDER BY {pk} LIMIT ?",
+                [last_key, cutoff, self.chunk_size],
+            )
+            if not rows:
+                return archived
+            last_key = rows[-1][pk]
+            chunk += 1
+
+            partitions = {}
+            for row in rows:
+                partitions.setdefault(str(row[timestamp])[:10], []).append(row)
+            part_rows = []
+            for date, partition_rows in partitions.items():
+                path = os.path.join(table, f"date={date}", f"part-{run_id}-{chunk:05d}{suffix}")
+                _write_part(os.path.join(self.directory, path), partition_rows)
+                part_rows.append(self._part_row(table, path, [row[pk] for row in partition_rows]))
+
+            self.storage.write(_move_to_archive, table, pk, self.tbl.name, part_rows, [row[pk] for row in rows])
+            # the next chunk is read through the reader, so this one has to be committed first
+            self.storage.flush()
+            archived += len(rows)
+            logger.info(f"Archived {archived} {table} rows")
+
+
+def _write_part(path: str, rows):
+    '''Write rows as compressed JSONL, atomically and synced to disk'''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as raw:
+        with io.TextIOWrapper(_compressor(path, raw), encoding='utf-8') as out:
+            for row in rows:
+                out.write(json.dumps(row, default=str) + '\n')
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(tmp, path)
+
+
+def _compressor(path: str, raw):
+    if path.endswith('.zst'):
+        import zstandard
+        return zstandard.ZstdCompressor(level=10).stream_writer(raw, closefd=False)
+    return gzip.GzipFile(fileobj=raw, mode='wb')
+
+
+def _read_part(path: str):
+    with open(path, 'rb') as raw:
+        if path.endswith('.zst'):
+            # only needed to read .zst parts, which are only written when it's installed
+            import zstandard
+            stream = zstandard.ZstdDecompressor().stream_reader(raw)
+        else:
+            stream = gzip.GzipFile(fileobj=raw, mode='rb')
+        for line in io.TextIOWrapper(stream, encoding='utf-8'):
+            yield json.loads(line)
+
+
+@functools.lru_cache(maxsize=PART_CACHE_SIZE)
+def _part_rows(path: str, pk: str):
+    '''A part file's rows by primary key'''
+    return {row[pk]: row for row in _read_part(path)}
+
+
+def _move_to_archive(db, table: str, pk: str, index_tbl: str, part_rows, keys):
+    db[index_tbl].insert_all(part_rows, replace=True)
+    for i in range(0, len(keys), 500):
+        batch = keys[i:i + 500]
+        db.execute(f"DELETE FROM {table} WHERE {pk} IN ({', '.join('?' * len(batch))})", batch)
+
+
+def compact(path: str):
+    '''VACUUM the database at path and truncate its WAL; returns (bytes before, bytes after)'''
+    from fastlite import Database
+
+    def size():
+        return sum(os.path.getsize(p) for p in (path, path + '-wal') if os.path.exists(p))
+
+    before = size()
+    db = Database(path)
+    db.execute("PRAGMA busy_timeout=30000")
+    db.execute("VACUUM")
+    db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    return before, size()
+
+
+archive = Archive(os.getenv("ARCHIVE_DIR", "archive"))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--older-than-days', type=float, default=float(os.getenv("ARCHIVE_AFTER_DAYS", 30)))
+    parser.add_argument('--dir', default=archive.directory, help="where the partitioned files go")
+    parser.add_argument('--tables', nargs='+', choices=list(ARCHIVED_TABLES), default=list(ARCHIVED_TABLES))
+    parser.add_argument('--chunk-size', type=int, default=archive.chunk_size, help="rows per file and transaction")
+    parser.add_argument('--no-vacuum', action='store_true', help="skip compacting the database afterwards")
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(args.log_level)
+    from storage import storage, setup_schema, schema_transaction
+
+    setup_schema()
+    archive.directory, archive.chunk_size = args.dir, args.chunk_size
+    with schema_transaction():
+        archive.attach(storage)
+
+    cutoff = (datetime.now() - timedelta(days=args.older_than_days)).isoformat()
+    start = time.monotonic()
+    counts = archive.run(cutoff, args.tables)
+    print(f"Archived rows older than {cutoff} to {args.dir} in {time.monotonic() - start:.1f}s: "
+          + ', '.join(f"{count} {table}" for table, count in counts.items()))
+    if not args.no_vacuum:
+        storage.flush()
+        before, after = compact(storage.path)
+        print(f"Compacted {storage.path}: {before / 1e6:.1f} MB -> {after / 1e6:.1f} MB")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
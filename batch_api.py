@@ -0,0 +1,424 @@
+'''
+Run prompt battles through the OpenAI Batch API instead of one call at a time.
+
+    python batch_api.py enqueue tasks.jsonl --session-id nightly
+    python batch_api.py run --session-id nightly --backend openai
+
+Pending stages of the session's battles are compiled into Batch API JSONL
+request files (one chat completion per line, keyed by custom_id
+`{battle_id}:{stage}`) and submitted through a backend; finished batches are
+downloaded and their results saved like any other stage, to the generation
+log and the battle row. A contender's prompt has to come back before its
+output stage can be compiled, so `run` keeps compiling, submitting and
+polling until every battle is complete or failed. `submit` and `poll` do a
+single round each, for cron-style runs.
+
+The `local` backend is a file-based stand-in for testing: it answers every
+request with the dummy backend's outputs when first polled.
+'''
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import logging
+import argparse
+from datetime import datetime
+
+from battles import CONTENDERS, save_stage
+from prompt_models import PromptModel, build_messages, dummy_output
+from storage import (
+    storage,
+    setup_schema,
+    create_battle,
+    reset_battle,
+    fail_battle,
+    get_completed_battle_ids,
+    battle_outputs,
+    battle_contenders,
+)
+
+logger = logging.getLogger(__name__)
+
+ENDPOINT = '/v1/chat/completions'
+
+# Batch statuses after which nothing more comes back; expired batches can still have partial results
+FINISHED_STATUSES = ('completed', 'expired', 'failed', 'cancelled')
+
+
+class BatchRequest:
+    custom_id: str
+    batch_id: str
+    battle_id: str
+    session_id: str
+    stage: str
+    input: str
+    status: str
+    attempts: int
+    result: str
+    error: str
+    submitted_at: str
+    finished_at: str
+
+
+class LocalBatchBackend:
+    '''
+    Batch API stand-in keeping each batch in a directory under `directory`.
+    A batch completes on the first poll at least `delay` seconds after it was
+    submitted, answering like the dummy backend.
+    '''
+    def __init__(self, directory: str = 'batches', delay: float = 0):
+        self.directory = directory
+        self.delay = delay
+
+    def submit(self, path: str) -> str:
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        os.makedirs(os.path.join(self.directory, batch_id))
+        shutil.copyfile(path, os.path.join(self.directory, batch_id, 'input.jsonl'))
+        return batch_id
+
+    def status(self, batch_id: str) -> str:
+        batch_dir = os.path.join(self.directory, batch_id)
+        if not os.path.exists(os.path.join(batch_dir, 'input.jsonl')):
+            return 'failed'
+        if os.path.exists(os.path.join(batch_dir, 'output.jsonl')):
+            return 'completed'
+        if time.time() - os.path.getmtime(os.path.join(batch_dir, 'input.jsonl')) < self.delay:
+            return 'in_progress'
+        self._complete(batch_dir)
+        return 'completed'
+
+    def results(self, batch_id: str):
+        path = os.path.join(self.directory, batch_id, 'output.jsonl')
+        if not os.path.exists(path):
+            return
+        with open(path) as f:
+            for line in f:
+                yield json.loads(line)
+
+    def _complete(self, batch_dir: str):
+        tmp = os.path.join(batch_dir, 'output.jsonl.tmp')
+        with open(os.path.join(batch_dir, 'input.jsonl')) as requests, open(tmp, 'w') as out:
+            for line in requests:
+                request = json.loads(line)
+                body = request['body']
+                messages = {message['role']: message['content'] for message in body['messages']}
+                system_prompt, user_prompt = messages.get('system', ""), messages.get('user', "")
+                content = dummy_output(system_prompt, user_prompt, body['model'])
+                if 'response_format' in body:
+                    content = PromptModel(
+                        original_input_user_prompt=user_prompt, system_prompt=system_prompt, user_prompt=content,
+                    ).model_dump_json()
+                out.write(json.dumps({
+                    'id': f"batch_req_{uuid.uuid4().hex}",
+                    'custom_id': request['custom_id'],
+                    'response': {'status_code': 200, 'body': {
+                        'model': body['model'],
+                        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content},
+                                     'finish_reason': 'stop'}],
+                    }},
+                    'error': None,
+                }) + '\n')
+        os.replace(tmp, os.path.join(batch_dir, 'output.jsonl'))
+
+
+class OpenAIBatchBackend:
+    '''The OpenAI Batch API: upload the request file, create a batch, download its output and error files'''
+    def __init__(self, completion_window: str = '24h'):
+        self.completion_window = completion_window
+
+    @property
+    def client(self):
+        from prompt_models import get_client
+        # the plain openai client under instructor's wrapper
+        return get_client().client
+
+    def submit(self, path: str) -> str:
+        with open(path, 'rb') as f:
+            uploaded = self.client.files.create(file=f, purpose='batch')
+        batch = self.client.batches.create(
+            input_file_id=uploaded.id, endpoint=ENDPOINT, completion_window=self.completion_window,
+        )
+        return batch.id
+
+    def status(self, batch_id: str) -> str:
+        return self.client.batches.retrieve(batch_id).status
+
+    def results(self, batch_id: str):
+        batch = self.client.batches.retrieve(batch_id)
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                for line in self.client.files.content(file_id).text.splitlines():
+                    if line.strip():
+                        yield json.loads(line)
+
+
+BACKENDS = {
+    'local': LocalBatchBackend,
+    'openai': OpenAIBatchBackend,
+}
+
+
+def prompt_response_format():
+    '''PromptModel as a strict json_schema response_format, the Batch API's stand-in for instructor'''
+    schema = PromptModel.model_json_schema()
+    schema['additionalProperties'] = False
+    return {'type': 'json_schema', 'json_schema': {'name': 'PromptModel', 'schema': schema, 'strict': True}}
+
+
+class BatchQueue:
+    '''
+    Compiles the pending stages of `session_id`'s battles into request files
+    under `directory` and tracks each request in the batch_request table
+    until its result is saved. A request that fails is compiled again next
+    round; after `max_attempts` its battle is failed.
+    '''
+    def __init__(self, backend, session_id: str = 'batch', directory: str = 'batches',
+                 max_requests_per_file: int = 50_000, max_attempts: int = 3, page_size: int = 1000):
+        self.backend = backend
+        self.session_id = session_id
+        self.directory = directory
+        self.max_requests_per_file = max_requests_per_file
+        self.max_attempts = max_attempts
+        self.page_size = page_size
+        self.contenders = {contender['name']: contender for contender in CONTENDERS}
+
+    def attach(self, storage):
+        self.storage = storage
+        self.tbl = storage.db.create(BatchRequest, pk='custom_id', transform=True)
+        self.tbl.create_index(['status', 'batch_id'], if_not_exists=True)
+        self.tbl.create_index(['battle_id'], if_not_exists=True)
+
+    def _pending_battles(self):
+        last_id = ''
+        while True:
+            page = self.storage.reader.q(
+                "SELECT * FROM battle WHERE session_id = ? AND status IN ('queued', 'running') AND battle_id > ? "
+                "ORDER BY battle_id LIMIT ?", [self.session_id, last_id, self.page_size]
+            )
+            if not page:
+                return
+            last_id = page[-1]['battle_id']
+            placeholders = ', '.join('?' * len(page))
+            requests = self.storage.reader.q(
+                f"SELECT * FROM {self.tbl.name} WHERE battle_id IN ({placeholders})", [b['battle_id'] for b in page]
+            )
+            by_custom_id = {request['custom_id']: request for request in requests}
+            for battle in page:
+                yield battle, by_custom_id
+
+    def _next_requests(self, battle, requests):
+        '''(tracking row, request line) for each contender stage of the battle that can be sent now'''
+        outputs = battle_outputs(battle)
+        for name in battle_contenders(battle) or []:
+            contender = self.contenders.get(name)
+            if contender is None:
+                logger.warning(f"Battle {battle['battle_id']} has unknown contender {name}, skipping it")
+                continue
+            prompt_stage, output_stage = f"{name}_prompt", f"{name}_output"
+            if output_stage in outputs:
+                continue
+            if prompt_stage not in outputs:
+                stage, stage_input = prompt_stage, battle['task']
+                body = {
+                    'model': contender['prompt_model'],
+                    'messages': build_messages(contender['system_prompt'], battle['task'], contender['prompt_model']),
+                    'response_format': prompt_response_format(),
+                }
+            else:
+                # the generated system prompt only survives in the prompt stage's batch result
+                prompt_result = requests.get(f"{battle['battle_id']}:{prompt_stage}", {}).get('result')
+                system_prompt = PromptModel.model_validate_json(prompt_result).system_prompt if prompt_result else ""
+                stage, stage_input = output_stage, outputs[prompt_stage]
+                body = {
+                    'model': contender['target_model'],
+                    'messages': build_messages(system_prompt, stage_input, contender['target_model']),
+                }
+            custom_id = f"{battle['battle_id']}:{stage}"
+            previous = requests.get(custom_id, {})
+            if previous.get('status') == 'submitted':
+                continue
+            yield dict(
+                custom_id=custom_id,
+                battle_id=battle['battle_id'],
+                session_id=battle['session_id'],
+                stage=stage,
+                input=stage_input,
+                status='submitted',
+                attempts=(previous.get('attempts') or 0) + 1,
+                result=None,
+                error=None,
+                finished_at=None,
+            ), {'custom_id': custom_id, 'method': 'POST', 'url': ENDPOINT, 'body': body}
+
+    def submit_pending(self):
+        '''Compile and submit every stage that can run now; returns how many requests were submitted'''
+        submitted, rows, path, out = 0, [], None, None
+        os.makedirs(self.directory, exist_ok=True)
+
+        def send():
+            nonlocal rows, path, out
+            out.close()
+            batch_id = self.backend.submit(path)
+            submitted_at = datetime.now().isoformat()
+            for row in rows:
+                row.update(batch_id=batch_id, submitted_at=submitted_at)
+            self.storage.write(_record_requests, self.tbl.name, rows)
+            logger.info(f"Submitted {len(rows)} requests from {path} as {batch_id}")
+            rows, path, out = [], None, None
+
+        try:
+            for battle, requests in self._pending_battles():
+                next_requests = list(self._next_requests(battle, requests))
+                if any(row['attempts'] > self.max_attempts for row, _ in next_requests):
+                    logger.warning(f"Battle {battle['battle_id']} failed {self.max_attempts} times, giving up")
+                    fail_battle(battle['battle_id'])
+                    continue
+                for row, line in next_requests:
+                    if out is None:
+                        path = os.path.join(self.directory, f"requests-{datetime.now():%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:6]}.jsonl")
+                        out = open(path, 'w')
+                    out.write(json.dumps(line) + '\n')
+                    rows.append(row)
+                    submitted += 1
+                    if len(rows) >= self.max_requests_per_file:
+                        send()
+            if rows:
+                send()
+        finally:
+            if out is not None:
+                out.close()
+        self.storage.flush()
+        return submitted
+
+    def poll(self):
+        '''Save the results of every finished batch; returns how many batches are still running'''
+        running = 0
+        for row in self.storage.reader.q(
+            f"SELECT DISTINCT batch_id FROM {self.tbl.name} WHERE status = 'submitted'"
+        ):
+            batch_id = row['batch_id']
+            status = self.backend.status(batch_id)
+            if status not in FINISHED_STATUSES:
+                running += 1
+                continue
+            requests = {
+                request['custom_id']: request for request in self.storage.reader.q(
+                    f"SELECT * FROM {self.tbl.name} WHERE batch_id = ? AND status = 'submitted'", [batch_id]
+                )
+            }
+            saved = 0
+            for result in self.backend.results(batch_id):
+                request = requests.pop(result.get('custom_id'), None)
+                if request is not None:
+                    saved += self._ingest(request, result)
+            # whatever didn't come back is compiled again next round
+            for request in requests.values():
+                self._finish(request, 'failed', error=f"batch {status} without a result")
+            logger.info(f"Batch {batch_id} {status}: {saved} results saved, {len(requests)} missing")
+        self.storage.flush()
+        return running
+
+    def _ingest(self, request, result) -> bool:
+        response = result.get('response') or {}
+        if result.get('error') or response.get('status_code') != 200:
+            self._finish(request, 'failed', error=json.dumps(result.get('error') or response.get('body')))
+            return False
+        try:
+            content = response['body']['choices'][0]['message']['content']
+            output = content
+            if request['stage'].endswith('_prompt'):
+                output = PromptModel.model_validate_json(content).user_prompt
+        except Exception as e:
+            self._finish(request, 'failed', error=f"unusable response: {e}")
+            return False
+        save_stage(request['battle_id'], request['session_id'], request['stage'], request['input'], output)
+        self._finish(request, 'done', result=content)
+        return True
+
+    def _finish(self, request, status: str, result=None, error=None):
+        self.storage.write(_finish_request, self.tbl.name, request['custom_id'], status, result, error,
+                           datetime.now().isoformat())
+
+    def run(self, poll_interval: float = 60):
+        '''Submit and poll until nothing is pending or running'''
+        while True:
+            running = self.poll()
+            submitted = self.submit_pending()
+            if not running and not submitted:
+                return
+            # with nothing running, what was just submitted is polled straight away
+            if running:
+                time.sleep(poll_interval)
+
+
+def _record_requests(db, tbl: str, rows):
+    db[tbl].insert_all(rows, replace=True)
+
+
+def _finish_request(db, tbl: str, custom_id: str, status: str, result, error, finished_at: str):
+    db.execute(
+        f"UPDATE {tbl} SET status = ?, result = ?, error = ?, finished_at = ? WHERE custom_id = ?",
+        [status, result, error, finished_at, custom_id],
+    )
+
+
+def enqueue(tasks_path: str, session_id: str):
+    '''Create a queued battle for each task in a batch_battles-style JSONL file; returns how many'''
+    from batch_battles import read_tasks
+
+    completed = get_completed_battle_ids()
+    queued = 0
+    for battle_id, task in read_tasks(tasks_path, session_id):
+        if battle_id in completed:
+            continue
+        # drop leftovers from an interrupted run before starting over
+        reset_battle(battle_id)
+        create_battle(battle_id, session_id, task, [contender['name'] for contender in CONTENDERS])
+        queued += 1
+    storage.flush()
+    return queued
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('command', choices=['enqueue', 'submit', 'poll', 'run'])
+    parser.add_argument('tasks', nargs='?', help="JSONL file of tasks, for enqueue")
+    parser.add_argument('--session-id', default='batch', help="only battles of this session are batched")
+    parser.add_argument('--backend', choices=list(BACKENDS), default='local')
+    parser.add_argument('--dir', default='batches', help="where request files (and local batches) are kept")
+    parser.add_argument('--poll-interval', type=float, default=60)
+    parser.add_argument('--max-requests-per-file', type=int, default=50_000)
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(args.log_level)
+    setup_schema()
+    backend = LocalBatchBackend(args.dir) if args.backend == 'local' else BACKENDS[args.backend]()
+    queue = BatchQueue(backend, session_id=args.session_id, directory=args.dir,
+                       max_requests_per_file=args.max_requests_per_file)
+    queue.attach(storage)
+
+    if args.command == 'enqueue':
+        if not args.tasks:
+            parser.error("enqueue needs a tasks file")
+        print(f"Queued {enqueue(args.tasks, args.session_id)} battles for session {args.session_id}")
+    elif args.command == 'submit':
+        print(f"Submitted {queue.submit_pending()} requests")
+    elif args.command == 'poll':
+        print(f"{queue.poll()} batches still running")
+    else:
+        start = time.monotonic()
+        queue.run(args.poll_interval)
+        print(f"Done in {time.monotonic() - start:.1f}s")
+
+    counts = storage.reader.q(
+        "SELECT status, count(*) AS n FROM battle WHERE session_id = ? GROUP BY status", [args.session_id]
+    )
+    print(', '.join(f"{row['n']} {row['status']}" for row in counts) or "No battles")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,131 @@
+'''
+Run prompt battles offline over a JSONL file of tasks.
+
+Each input line is a JSON object with the task under `task` (or `user_input`,
+`prompt`, `body`) and an optional `id`. Battles are stored in the same database
+the app uses, so graders see them like any other battle; tasks whose battle is
+already complete are skipped, which makes interrupted runs resumable. One JSON
+result per battle is appended to the output file as soon as it finishes.
+
+    python batch_battles.py tasks.jsonl -o results.jsonl --concurrency 32 --backend dummy
+'''
+import sys
+import json
+import time
+import uuid
+import asyncio
+import logging
+import argparse
+
+import battles
+from battles import run_battle, contender_names
+from storage import storage, create_battle, reset_battle, get_completed_battle_ids
+
+logger = logging.getLogger(__name__)
+
+TASK_FIELDS = ('task', 'user_input', 'prompt', 'body')
+
+
+def read_tasks(path: str, session_id: str):
+    '''
+    Yields (battle_id, task) for each usable line, lazily so huge files stay out
+    of memory. Only the first line with a given battle_id runs; repeated tasks
+    without an `id` get the same one.
+    '''
+    seen = set()
+    with open(path) as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            task = next((record[field] for field in TASK_FIELDS if record.get(field)), None)
+            if task is None:
+                logger.warning(f"Line {line_number}: no task field, skipping")
+                continue
+            battle_id = str(record.get('id') or uuid.uuid5(uuid.NAMESPACE_URL, f"{session_id}:{task}"))
+            if battle_id in seen:
+                logger.warning(f"Line {line_number}: battle {battle_id} is already in this file, skipping")
+                continue
+            seen.add(battle_id)
+            yield battle_id, task
+
+
+def percentile(values, q: float):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def run_batch(tasks, output_path: str, concurrency: int, session_id: str, completed: set):
+    latencies = []
+    counts = {'complete': 0, 'failed': 0, 'skipped': 0}
+    lock = asyncio.Lock()
+
+    with open(output_path, 'a') as out:
+        async def worker():
+            for battle_id, task in tasks:
+                if battle_id in completed:
+                    counts['skipped'] += 1
+                    continue
+                # drop leftovers from an interrupted run before starting over
+                reset_battle(battle_id)
+                create_battle(battle_id, session_id, task, contender_names())
+                start = time.monotonic()
+                results = await run_battle(task, session_id, battle_id)
+                latency = time.monotonic() - start
+
+                status = 'complete' if all(f'{name}_output' in results for name in contender_names()) else 'failed'
+                counts[status] += 1
+                latencies.append(latency)
+                result = {'id': battle_id, 'task': task, 'status': status}
+                for name in contender_names():
+                    result[f'{name}_prompt'] = getattr(results.get(f'{name}_prompt'), 'user_prompt', None)
+                    result[f'{name}_output'] = results.get(f'{name}_output')
+                result['latency_s'] = round(latency, 3)
+                async with lock:
+                    out.write(json.dumps(result) + '\n')
+                    out.flush()
+
+        # workers share one task iterator, so at most `concurrency` battles are in flight
+        started = time.monotonic()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.monotonic() - started
+
+    storage.flush()
+    return counts, latencies, elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('tasks', help="JSONL file of tasks")
+    parser.add_argument('-o', '--output', default='battle_results.jsonl', help="JSONL file results are appended to")
+    parser.add_argument('-c', '--concurrency', type=int, default=16, help="battles run at once")
+    parser.add_argument('--backend', choices=['dummy', 'openai'], default=battles.LLM_BACKEND,
+                        help="call_dummy_llm stand-ins or the real OpenAI models")
+    parser.add_argument('--session-id', default='batch', help="session_id recorded on the generated battles")
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(args.log_level)
+    battles.set_llm_backend(args.backend)
+    battles.setup()
+
+    completed = get_completed_battle_ids()
+    tasks = read_tasks(args.tasks, args.session_id)
+    counts, latencies, elapsed = asyncio.run(
+        run_batch(tasks, args.output, args.concurrency, args.session_id, completed)
+    )
+
+    ran = counts['complete'] + counts['failed']
+    print(f"{ran} battles in {elapsed:.1f}s ({ran / elapsed if elapsed else 0:.2f} battles/s), "
+          f"{counts['complete']} complete, {counts['failed']} failed, {counts['skipped']} skipped as already done")
+    if latencies:
+        print(f"latency p50 {percentile(latencies, 0.5):.2f}s  p95 {percentile(latencies, 0.95):.2f}s  "
+              f"max {max(latencies):.2f}s")
+    return 0 if counts['failed'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
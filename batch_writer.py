@@ -0,0 +1,78 @@
+import queue
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class BatchWriter:
+    '''
+    Background thread that collects rows and hands them to `write_batch` in groups,
+    so callers on the request path only pay for a queue put. A batch is written
+    once `batch_size` rows are waiting or the oldest row has waited `max_delay` seconds.
+    '''
+    def __init__(self, write_batch, batch_size: int = 100, max_delay: float = 0.05, name: str = "batch-writer"):
+        self.write_batch = write_batch
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def put(self, row):
+        self._queue.put(row)
+
+    def flush(self, timeout: float = None):
+        '''Block until everything queued so far has been written'''
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(timeout)
+
+    def close(self, timeout: float = 10):
+        '''Write out whatever is still queued and stop the thread'''
+        if not self._thread.is_alive():
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            batch, waiters, stop = [], [], False
+            deadline = time.monotonic() + self.max_delay
+            while True:
+                if item is _STOP:
+                    stop = True
+                elif isinstance(item, threading.Event):
+                    waiters.append(item)
+                else:
+                    batch.append(item)
+                if stop or waiters or len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+
+            if batch:
+                try:
+                    self.write_batch(batch)
+                except Exception:
+                    logger.exception(f"Failed to write batch of {len(batch)} rows")
+            for waiter in waiters:
+                waiter.set()
+            if stop:
+                # anything queued after close() was called still gets written
+                remaining = []
+                while not self._queue.empty():
+                    leftover = self._queue.get()
+                    if isinstance(leftover, threading.Event):
+                        leftover.set()
+                    elif leftover is not _STOP:
+                        remaining.append(leftover)
+                if remaining:
+                    self.write_batch(remaining)
+                return
@@ -0,0 +1,295 @@
+import os
+import re
+import json
+import time
+import asyncio
+import logging
+from contextlib import contextmanager
+from datetime import datetime
+
+from prompt_models import (
+    PROMPT_GEN_SYSTEM_PROMPT,
+    PromptModel,
+    acall_llm,
+    acall_dummy_llm,
+)
+from events import battle_events
+from streaming import coalesce_chunks
+from llm_cache import response_cache
+from pipeline import Pipeline
+from singleflight import single_flight
+from scheduler import scheduler
+from metrics import llm_call_seconds, llm_errors, battles_in_flight, battles_finished
+from storage import (
+    storage,
+    setup_schema,
+    insert_generation,
+    update_battle_stage,
+    fail_battle,
+    cancel_battle as mark_battle_cancelled,
+)
+
+logger = logging.getLogger(__name__)
+
+# "dummy" uses the call_dummy_llm stand-ins, "openai" the real models
+LLM_BACKEND = os.getenv("LLM_BACKEND", "dummy")
+
+# Default models that write the prompts and run them, and how often streamed tokens are pushed to the page
+PROMPT_MODEL = "gpt-4o-mini"
+TARGET_MODEL = "gpt-4o-mini"
+STREAM_FLUSH_INTERVAL = 0.05
+
+# The original two contenders; sleep_time is how long each of the dummy backend's calls takes
+DEFAULT_CONTENDER_CONFIGS = [
+    {'name': 'o1', 'system_prompt': "", 'sleep_time': 2},
+    {'name': 'challenger', 'system_prompt': PROMPT_GEN_SYSTEM_PROMPT, 'sleep_time': 1},
+]
+
+
+def load_contenders(spec=None):
+    '''
+    Contender configurations from `spec`: a JSON list, or the path to a file
+    holding one, of {"name", "system_prompt", "prompt_model", "target_model",
+    "sleep_time"} objects where only the name is required. Names go into stage
+    names and the leaderboard, so they must be unique and [A-Za-z0-9_-].
+    '''
+    configs = DEFAULT_CONTENDER_CONFIGS
+    if spec:
+        if not spec.lstrip().startswith('['):
+            with open(spec) as f:
+                spec = f.read()
+        configs = json.loads(spec)
+    contenders = []
+    for config in configs:
+        name = config['name']
+        if not re.fullmatch(r'[A-Za-z0-9_-]+', name) or name in {c['name'] for c in contenders}:
+            raise ValueError(f"Contender names must be unique and [A-Za-z0-9_-]: {name!r}")
+        contenders.append({
+            'name': name,
+            'system_prompt': config.get('system_prompt', ""),
+            'prompt_model': config.get('prompt_model', PROMPT_MODEL),
+            'target_model': config.get('target_model', TARGET_MODEL),
+            'sleep_time': config.get('sleep_time', 0),
+        })
+    if len(contenders) < 2:
+        raise ValueError("A battle needs at least two contenders")
+    return contenders
+
+
+CONTENDERS = load_contenders(os.getenv("BATTLE_CONTENDERS"))
+
+# Contender stages generating at once across all battles, so wide battles can't flood the LLM clients
+CONTENDER_CONCURRENCY = int(os.getenv("CONTENDER_CONCURRENCY", 32))
+_contender_slots = None  # (loop, semaphore)
+
+
+def contender_slots():
+    '''The contender semaphore, made on first use in the running loop (and again if the loop changes)'''
+    global _contender_slots
+    loop = asyncio.get_running_loop()
+    if _contender_slots is None or _contender_slots[0] is not loop:
+        _contender_slots = (loop, asyncio.Semaphore(CONTENDER_CONCURRENCY))
+    return _contender_slots[1]
+
+# Everything besides the task that determines a battle's outputs; identical in-flight battles are shared
+BATTLE_CONFIG = {
+    'contenders': CONTENDERS,
+    'backend': LLM_BACKEND,
+}
+
+
+def contender_names(contenders=None):
+    return [contender['name'] for contender in contenders or CONTENDERS]
+
+
+def setup():
+    '''Create the tables and attach the db-backed response cache; call once before running battles'''
+    setup_schema()
+    response_cache.attach(storage)
+
+
+def set_llm_backend(backend: str):
+    global LLM_BACKEND
+    LLM_BACKEND = backend
+    BATTLE_CONFIG['backend'] = backend
+
+
+# Optional callable returning a sleep_time for each dummy call, overriding the fixed ones (used by benchmarks)
+dummy_latency = None
+
+
+def set_dummy_latency(sampler):
+    global dummy_latency
+    dummy_latency = sampler
+
+
+async def llm(sleep_time: float = 0, **kwargs):
+    '''
+    acall_llm or its dummy stand-in, depending on LLM_BACKEND; sleep_time only
+    applies to the dummy. With a dummy_latency sampler each (hedged) attempt
+    draws its own latency.
+    '''
+    if LLM_BACKEND == "openai":
+        return await acall_llm(**kwargs)
+    return await acall_dummy_llm(sleep_time=dummy_latency if dummy_latency is not None else sleep_time, **kwargs)
+
+
+@contextmanager
+def timed_llm_call(model: str, call_type: str):
+    '''Record the latency of the LLM call made inside the block, or count it as an error if it raises'''
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        llm_errors.inc(model=model, call_type=call_type)
+        raise
+    llm_call_seconds.observe(time.perf_counter() - start, model=model, call_type=call_type)
+
+
+async def generate_prompt(user_input: str, session_id, call_id: str, stage: str, system_prompt: str = "",
+                          sleep_time: float = 0, model: str = PROMPT_MODEL):
+    logger.debug(f"Getting {stage} for: {user_input}")
+    async with contender_slots():
+        with timed_llm_call(model, stage):
+            prompt = await llm(
+                system_prompt=system_prompt,
+                user_prompt=user_input,
+                model_name=model,
+                response_model=PromptModel,
+                sleep_time=sleep_time,
+            )
+    logger.debug(f"{stage}: {prompt.user_prompt}")
+    record_stage(call_id, session_id, stage, user_input, prompt.user_prompt)
+    return prompt
+
+
+def build_battle_pipeline(user_input: str, session_id, call_id: str, contenders=None):
+    '''
+    Each contender is its own chain: generate a prompt with its system prompt,
+    then run that prompt on its target model. The chains don't wait on each
+    other, so outputs land as soon as each contender is done.
+    '''
+    pipeline = Pipeline()
+    for contender in contenders or CONTENDERS:
+        add_contender_stages(pipeline, contender, user_input, session_id, call_id)
+    return pipeline
+
+
+def add_contender_stages(pipeline: Pipeline, contender: dict, user_input: str, session_id, call_id: str):
+    prompt_stage, output_stage = f"{contender['name']}_prompt", f"{contender['name']}_output"
+    pipeline.add_stage(
+        prompt_stage,
+        lambda: generate_prompt(
+            user_input, session_id, call_id, prompt_stage,
+            system_prompt=contender['system_prompt'],
+            sleep_time=contender['sleep_time'],
+            model=contender['prompt_model'],
+        ),
+    )
+    pipeline.add_stage(
+        output_stage,
+        lambda **inputs: run_prompt_on_target(
+            inputs[prompt_stage], session_id, call_id, output_stage,
+            model=contender['target_model'], sleep_time=contender['sleep_time'],
+        ),
+        depends_on=[prompt_stage],
+    )
+
+
+async def run_battle(user_input: str, session_id, call_id: str, contenders=None):
+    failed = []
+
+    def stage_failed(stage, exc):
+        failed.append(stage)
+        for member_id, _ in single_flight.members(call_id):
+            battle_events.publish(member_id, f'{stage}_failed', str(exc))
+
+    battles_in_flight.inc()
+    try:
+        pipeline = build_battle_pipeline(user_input, session_id, call_id, contenders)
+        results = await pipeline.run(on_stage_failed=stage_failed)
+    except asyncio.CancelledError:
+        battles_finished.inc(status='cancelled')
+        raise
+    finally:
+        battles_in_flight.dec()
+    if failed:
+        for member_id, _ in single_flight.members(call_id):
+            fail_battle(member_id)
+    battles_finished.inc(status='failed' if failed else 'complete')
+    return results
+
+
+async def run_flight(flight_key: str, user_input: str, session_id, call_id: str):
+    '''Run the battle for a single-flight leader, fanning results out to everyone who joined'''
+    try:
+        return await run_battle(user_input, session_id, call_id)
+    finally:
+        single_flight.finish(flight_key, call_id)
+
+
+def cancel_battle(call_id: str, reason: str):
+    '''
+    Stop generating call_id's battle for nobody. It stops getting results from
+    its single-flight, and once no member of the flight is left the run itself
+    is cancelled, whether it's still queued or already calling the LLMs.
+    Battles that already finished are left alone.
+    '''
+    mark_battle_cancelled(call_id)
+    flight, remaining = single_flight.leave(call_id)
+    if flight is None:
+        return
+    logger.debug(f"Cancelling call_id: {call_id} ({reason}), {remaining} other members in its flight")
+    battle_events.publish(call_id, 'cancelled', reason)
+    if not remaining:
+        scheduler.cancel(flight.leader_id)
+        # identical submissions from now on start a fresh battle instead of joining this one
+        single_flight.finish(flight.key, flight.leader_id)
+
+
+async def run_prompt_on_target(prompt: PromptModel, session_id, call_id: str, output_stage: str,
+                               model: str = TARGET_MODEL, sleep_time: float = 0):
+    '''Stream the generated prompt's completion from the target model, pushing coalesced chunks as they arrive'''
+    logger.debug(f"Getting final output for: {call_id}-{output_stage}")
+    output = ''
+    async with contender_slots():
+        with timed_llm_call(model, output_stage):
+            chunks = await llm(
+                system_prompt=prompt.system_prompt,
+                user_prompt=prompt.user_prompt,
+                model_name=model,
+                sleep_time=sleep_time,
+                stream=True,
+            )
+            async for chunk in coalesce_chunks(chunks, STREAM_FLUSH_INTERVAL):
+                output += chunk
+                for member_id, _ in single_flight.members(call_id):
+                    battle_events.publish(member_id, f'{output_stage}_partial', output)
+
+    record_stage(call_id, session_id, output_stage, prompt.user_prompt, output)
+    return output
+
+
+def record_stage(call_id: str, session_id, stage: str, stage_input: str, output: str):
+    '''
+    Persist a finished stage to the generation log and the battle row, then notify
+    listeners; done for every call_id sharing this battle through single-flight.
+    '''
+    single_flight.record(call_id, stage, stage_input, output)
+    for member_id, member_session_id in single_flight.members(call_id, session_id):
+        save_stage(member_id, member_session_id, stage, stage_input, output)
+
+
+def save_stage(call_id: str, session_id, stage: str, stage_input: str, output: str):
+    timestamp = datetime.now().isoformat()
+    logger.debug(f"Inserting generation into database: {call_id}-{stage}:\n{output}")
+    insert_generation(dict(
+        call_id=f'{call_id}-{stage}',
+        session_id=session_id,
+        call_type=stage,
+        input=stage_input,
+        output=output,
+        timestamp=timestamp,
+    ))
+    update_battle_stage(call_id, stage, output, timestamp)
+    battle_events.publish(call_id, stage, output)
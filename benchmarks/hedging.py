@@ -0,0 +1,95 @@
+'''
+Hedged-request demo: the same stream of dummy LLM calls with heavy-tailed
+latencies, once without hedging and once with it, comparing the latency the
+caller sees and how many extra requests hedging cost.
+
+    python -m benchmarks.hedging --calls 2000 --latency pareto:0.05:1.5 --percentile 0.95 --max-hedge-rate 0.05
+
+Each call draws its own latency, so a hedge is an independent second draw, as
+a retry against a real provider would be. Reports p50/p95/p99/max call
+latency, the hedge rate and which attempt answered, as JSON.
+'''
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+from datetime import datetime
+
+from benchmarks.load_test import parse_latency, percentiles
+
+
+async def run(args, sample):
+    from prompt_models import acall_dummy_llm, PromptModel
+
+    attempts = 0
+
+    def draw():
+        # called once per attempt, so this counts the hedges too
+        nonlocal attempts
+        attempts += 1
+        return sample()
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+
+    async def one():
+        async with semaphore:
+            start = time.perf_counter()
+            await acall_dummy_llm(user_prompt="hedging demo", model_name='dummy', response_model=PromptModel,
+                                  sleep_time=draw, use_cache=False)
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(one() for _ in range(args.calls)))
+    return {
+        'latency_s': percentiles(latencies),
+        'requests': attempts,
+        'hedge_rate': round(attempts / args.calls - 1, 4),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--calls', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--latency', default='pareto:0.05:1.5', help="see benchmarks.load_test --latency")
+    parser.add_argument('--percentile', type=float, default=0.95, help="hedge calls slower than this")
+    parser.add_argument('--max-hedge-rate', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault('OPENAI_API_KEY', 'hedging')
+    import prompt_models
+    from hedging import Hedger, llm_hedges
+
+    results = {}
+    for name, enabled in (('unhedged', False), ('hedged', True)):
+        random.seed(args.seed)
+        # acall_dummy_llm hedges through prompt_models.hedger, swapped for one configured per run
+        prompt_models.hedger = Hedger(percentile=args.percentile, max_hedge_rate=args.max_hedge_rate, enabled=enabled)
+        results[name] = asyncio.run(run(args, parse_latency(args.latency)))
+    results['hedged']['answered_by'] = {
+        outcome: llm_hedges.value(model='dummy', outcome=outcome)
+        for outcome in ('primary', 'hedge', 'over_budget')
+    }
+
+    report = {
+        'benchmark': 'hedging',
+        'timestamp': datetime.now().isoformat(),
+        'config': vars(args),
+        'results': results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,108 @@
+'''
+Cold-start benchmark: how long a fresh interpreter takes to import the app and
+run its startup hook, which is what every process start and every dev reload
+pays. Each run is a new subprocess against a temporary database.
+
+    python -m benchmarks.import_time --runs 5 --budget-ms 1500
+
+Reports median/max import and startup times plus the slowest modules by
+cumulative import time (from -X importtime) as JSON, and exits non-zero when
+the median import + startup time is over --budget-ms (1500 by default, about
+twice a lazy-import cold start; 0 turns the check off), for CI.
+'''
+import os
+import sys
+import json
+import argparse
+import tempfile
+import statistics
+import subprocess
+from datetime import datetime
+
+PROBE = '''
+import json, time
+start = time.perf_counter()
+import {module} as target
+imported = time.perf_counter()
+{startup}
+ready = time.perf_counter()
+print("IMPORT_TIME " + json.dumps({{"import_ms": (imported - start) * 1000, "startup_ms": (ready - imported) * 1000}}))
+'''
+
+
+def run_once(module: str, startup: str, env: dict, importtime: bool = False):
+    command = [sys.executable]
+    if importtime:
+        command += ['-X', 'importtime']
+    command += ['-c', PROBE.format(module=module, startup=startup)]
+    result = subprocess.run(command, capture_output=True, text=True, env=env)
+    line = next((l for l in result.stdout.splitlines() if l.startswith('IMPORT_TIME ')), None)
+    if result.returncode != 0 or line is None:
+        raise RuntimeError(f"Probe failed:\n{result.stderr[-2000:]}")
+    return json.loads(line.removeprefix('IMPORT_TIME ')), result.stderr
+
+
+def slowest_modules(importtime_output: str, top: int):
+    '''(module, cumulative ms) from -X importtime output, slowest first'''
+    modules = []
+    for line in importtime_output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.removeprefix('import time:').split('|')
+        modules.append((name.strip(), int(cumulative) / 1000))
+    # only count top-level packages once, as the outermost import
+    seen, result = set(), []
+    for name, ms in sorted(modules, key=lambda m: m[1], reverse=True):
+        root = name.split('.')[0]
+        if root in seen:
+            continue
+        seen.add(root)
+        result.append({'module': name, 'cumulative_ms': round(ms, 1)})
+    return result[:top]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--module', default='app', help="module to import")
+    parser.add_argument('--startup', default='target.startup()', help="statement run after the import")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10, help="slowest modules to list")
+    parser.add_argument('--budget-ms', type=float, default=1500,
+                        help="fail if median import + startup exceeds this, 0 to only report")
+    parser.add_argument('--output', help="write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+
+    env = dict(os.environ)
+    env['PROMPT_BATTLE_DB'] = os.path.join(tempfile.mkdtemp(), 'import_time.db')
+    env.setdefault('OPENAI_API_KEY', 'import-time')
+
+    timings = [run_once(args.module, args.startup, env)[0] for _ in range(args.runs)]
+    _, importtime_output = run_once(args.module, args.startup, env, importtime=True)
+
+    imports = [t['import_ms'] for t in timings]
+    startups = [t['startup_ms'] for t in timings]
+    totals = [i + s for i, s in zip(imports, startups)]
+    median_total = statistics.median(totals)
+    report = {
+        'benchmark': 'import_time',
+        'timestamp': datetime.now().isoformat(),
+        'config': vars(args),
+        'results': {
+            'import_ms': {'median': round(statistics.median(imports), 1), 'max': round(max(imports), 1)},
+            'startup_ms': {'median': round(statistics.median(startups), 1), 'max': round(max(startups), 1)},
+            'total_ms': {'median': round(median_total, 1), 'max': round(max(totals), 1)},
+            'within_budget': None if not args.budget_ms else median_total <= args.budget_ms,
+            'slowest_modules': slowest_modules(importtime_output, args.top),
+        },
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return 1 if report['results']['within_budget'] is False else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
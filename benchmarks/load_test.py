@@ -0,0 +1,265 @@
+'''
+Load test for the /output -> /check_generations (or /battle_events) flow.
+
+Starts the app in-process on a local port with the dummy LLM backend, then
+simulates browser clients that submit a task and follow it the way htmx does:
+polling /check_generations every 500ms with the `since` etag, or holding the
+/battle_events SSE stream open. Reports time-to-first-prompt and
+time-to-final-output percentiles, request throughput, peak thread count and
+SQLite lock waits as JSON so runs can be compared across releases.
+
+    python -m benchmarks.load_test --clients 200 --latency lognormal:0.5:0.6 --output bench.json
+'''
+import os
+import re
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import tempfile
+import threading
+import subprocess
+from datetime import datetime
+
+import httpx
+
+POLL_INTERVAL = 0.5
+PLACEHOLDERS = ("Generating...", "Waiting for a free worker...", "Queued...")
+
+
+def parse_latency(spec: str):
+    '''
+    Sampler for dummy LLM latency in seconds: constant:S, uniform:LO:HI,
+    lognormal:MU:SIGMA (of the underlying normal) or pareto:SCALE:ALPHA.
+    '''
+    kind, *params = spec.split(':')
+    params = [float(p) for p in params]
+    if kind == 'constant':
+        return lambda: params[0]
+    if kind == 'uniform':
+        return lambda: random.uniform(params[0], params[1])
+    if kind == 'lognormal':
+        return lambda: random.lognormvariate(params[0], params[1])
+    if kind == 'pareto':
+        return lambda: params[0] * random.paretovariate(params[1])
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+def percentiles(values):
+    if not values:
+        return None
+    ordered = sorted(values)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 4)
+
+    return {'p50': pick(0.50), 'p95': pick(0.95), 'p99': pick(0.99), 'max': round(ordered[-1], 4)}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def git_rev():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+class Stats:
+    def __init__(self):
+        self.requests = 0
+        self.first_prompt = []
+        self.final_output = []
+        self.completed = 0
+        self.rejected = 0
+        self.errors = 0
+        self.lock_waits = 0
+        self.max_threads = threading.active_count()
+
+
+def start_server(port: int, args, stats: Stats):
+    # The db location and backend are read at import, so set them first
+    os.environ['PROMPT_BATTLE_DB'] = os.path.join(tempfile.mkdtemp(), 'load_test.db')
+    os.environ['LLM_BACKEND'] = 'dummy'
+    import uvicorn
+    import storage
+    import battles
+    from llm_cache import response_cache
+    import app as battle_app
+
+    battles.set_dummy_latency(parse_latency(args.latency))
+    response_cache.enabled = False
+    battle_app.scheduler.num_workers = args.workers
+    battle_app.scheduler.max_queue_size = args.queue_size
+
+    def busy_handler(attempts):
+        # Count every time SQLite reports a lock, then back off like busy_timeout would
+        stats.lock_waits += 1
+        time.sleep(min(0.001 * (attempts + 1), 0.05))
+        return attempts < 1000
+
+    configure = storage.Storage._configure
+
+    def configure_with_busy_handler(db):
+        configure(db)
+        if hasattr(db.conn, 'set_busy_handler'):
+            db.conn.set_busy_handler(busy_handler)
+
+    storage.Storage._configure = staticmethod(configure_with_busy_handler)
+    configure_with_busy_handler(storage.storage.db)
+
+    server = uvicorn.Server(uvicorn.Config(battle_app.app, host='127.0.0.1', port=port, log_level='warning'))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, thread
+
+
+async def poll_client(http, call_id, start, stats: Stats):
+    '''Follow call_id by polling; True once every output is done, False if it ended cancelled or failed'''
+    since = None
+    first_prompt_at = None
+    while True:
+        params = {'call_id': call_id}
+        if since:
+            params['since'] = since
+        r = await http.get('/check_generations', params=params)
+        stats.requests += 1
+        etag = (r.headers.get('etag') or '').strip('"')
+        codes = etag.split('.') if etag else []
+        if first_prompt_at is None and 'd' in codes[:2]:
+            first_prompt_at = time.monotonic() - start
+            stats.first_prompt.append(first_prompt_at)
+        if r.status_code == 200:
+            match = re.search(r'since=([^"&]+)', r.text)
+            if match:
+                since = match.group(1)
+            elif codes:
+                # poller removed: battle finished, but only counts if no box ended (c)ancelled or (f)ailed
+                if 'c' in codes or 'f' in codes:
+                    return False
+                stats.final_output.append(time.monotonic() - start)
+                return True
+        await asyncio.sleep(POLL_INTERVAL)
+
+
+async def sse_client(http, call_id, start, stats: Stats):
+    '''Follow call_id over SSE; True once every output is done, False if it ended cancelled or failed'''
+    first_prompt_at = None
+    unfinished = False
+    stats.requests += 1
+    async with http.stream('GET', '/battle_events', params={'call_id': call_id}) as r:
+        async for line in r.aiter_lines():
+            if re.search(r'<p[^>]*>(Cancelled|Generation failed)</p>', line):
+                unfinished = True
+            if first_prompt_at is None:
+                for box, text in re.findall(r'id="output-box([12])-content"[^>]*><p[^>]*>([^<]*)', line):
+                    if text and text not in PLACEHOLDERS:
+                        first_prompt_at = time.monotonic() - start
+                        stats.first_prompt.append(first_prompt_at)
+                        break
+    if unfinished:
+        return False
+    stats.final_output.append(time.monotonic() - start)
+    return True
+
+
+async def run_client(base_url: str, client_id: int, args, stats: Stats):
+    await asyncio.sleep(random.uniform(0, args.ramp))
+    # a client (and cookie jar) per grader: a new battle in a session cancels that session's previous one
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout) as http:
+        for battle in range(args.battles_per_client):
+            start = time.monotonic()
+            try:
+                r = await http.post('/output', data={'user_input': f"load test task {client_id}-{battle} {random.random()}"})
+                stats.requests += 1
+                if r.status_code == 503:
+                    stats.rejected += 1
+                    continue
+                call_id = re.search(r'call_id=([0-9a-f-]+)', r.text).group(1)
+                follow = sse_client if args.mode == 'sse' else poll_client
+                if await asyncio.wait_for(follow(http, call_id, start, stats), timeout=args.timeout):
+                    stats.completed += 1
+                else:
+                    stats.errors += 1
+            except Exception:
+                stats.errors += 1
+
+
+async def sample_threads(stats: Stats, stop: asyncio.Event):
+    while not stop.is_set():
+        stats.max_threads = max(stats.max_threads, threading.active_count())
+        await asyncio.sleep(0.1)
+
+
+async def run(args, port: int, stats: Stats):
+    stop = asyncio.Event()
+    sampler = asyncio.create_task(sample_threads(stats, stop))
+    started = time.monotonic()
+    await asyncio.gather(*(run_client(f'http://127.0.0.1:{port}', i, args, stats) for i in range(args.clients)))
+    elapsed = time.monotonic() - started
+    stop.set()
+    await sampler
+    return elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--clients', type=int, default=50, help="simulated graders")
+    parser.add_argument('--battles-per-client', type=int, default=1)
+    parser.add_argument('--mode', choices=['poll', 'sse'], default='poll', help="how clients follow a battle")
+    parser.add_argument('--latency', default='constant:1', help="dummy LLM sleep_time distribution")
+    parser.add_argument('--workers', type=int, default=4, help="generation scheduler workers")
+    parser.add_argument('--queue-size', type=int, default=64, help="generation scheduler queue size")
+    parser.add_argument('--ramp', type=float, default=1.0, help="seconds over which clients start")
+    parser.add_argument('--timeout', type=float, default=120.0, help="per-battle timeout")
+    parser.add_argument('--output', help="write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+
+    stats = Stats()
+    port = free_port()
+    server, thread = start_server(port, args, stats)
+    try:
+        elapsed = asyncio.run(run(args, port, stats))
+    finally:
+        server.should_exit = True
+        thread.join(10)
+
+    report = {
+        'benchmark': 'load_test',
+        'timestamp': datetime.now().isoformat(),
+        'git_rev': git_rev(),
+        'config': vars(args),
+        'results': {
+            'elapsed_s': round(elapsed, 3),
+            'battles_completed': stats.completed,
+            'battles_rejected': stats.rejected,
+            'errors': stats.errors,
+            'requests': stats.requests,
+            'requests_per_s': round(stats.requests / elapsed, 2),
+            'battles_per_s': round(stats.completed / elapsed, 2),
+            'time_to_first_prompt_s': percentiles(stats.first_prompt),
+            'time_to_final_output_s': percentiles(stats.final_output),
+            'max_threads': stats.max_threads,
+            'sqlite_lock_waits': stats.lock_waits,
+        },
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return 0 if stats.errors == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,187 @@
+'''
+Local stand-in for the OpenAI chat completions API that enforces its own rate
+limits, answering with 429 + Retry-After like the real thing, to exercise the
+client-side limiter in rate_limit.py without spending money.
+
+By default it starts the stand-in on a local port, points acall_llm at it and
+fires a burst of structured and streamed calls, then reports how many 429s the
+server had to send, how many calls succeeded and where the adaptive
+concurrency limit settled. `--serve` only runs the server.
+
+    python -m benchmarks.rate_limit_standin --calls 300 --server-rps 4 --server-concurrency 3
+'''
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import asyncio
+import argparse
+import threading
+from collections import deque
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+
+class StandinLimits:
+    '''Sliding one-second request window plus a cap on concurrent requests'''
+    def __init__(self, rps: float, max_concurrency: int, latency: float):
+        self.rps = rps
+        self.max_concurrency = max_concurrency
+        self.latency = latency
+        self.in_flight = 0
+        self.recent = deque()
+        self.counts = {'ok': 0, 'rate_limited': 0}
+
+    def admit(self):
+        '''None if the request may proceed, else the Retry-After seconds to send'''
+        now = time.monotonic()
+        while self.recent and now - self.recent[0] > 1:
+            self.recent.popleft()
+        if len(self.recent) >= self.rps or self.in_flight >= self.max_concurrency:
+            self.counts['rate_limited'] += 1
+            return 1 if len(self.recent) >= self.rps else 0.5
+        self.recent.append(now)
+        self.in_flight += 1
+        self.counts['ok'] += 1
+        return None
+
+
+def fake_arguments(tool):
+    '''Arguments satisfying the tool's JSON schema, enough for instructor to parse'''
+    schema = tool['function'].get('parameters', {})
+    return json.dumps({name: f"stand-in {name}" for name in schema.get('properties', {})})
+
+
+def completion(body):
+    message = {'role': 'assistant', 'content': "stand-in completion"}
+    if body.get('tools'):
+        tool = body['tools'][0]
+        message = {'role': 'assistant', 'content': None, 'tool_calls': [{
+            'id': f"call_{uuid.uuid4().hex[:8]}",
+            'type': 'function',
+            'function': {'name': tool['function']['name'], 'arguments': fake_arguments(tool)},
+        }]}
+    return {
+        'id': f"chatcmpl-{uuid.uuid4().hex}",
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': body.get('model'),
+        'choices': [{'index': 0, 'message': message, 'finish_reason': 'stop'}],
+        'usage': {'prompt_tokens': 10, 'completion_tokens': 10, 'total_tokens': 20},
+    }
+
+
+def create_app(limits: StandinLimits):
+    async def chat_completions(request):
+        body = await request.json()
+        retry_after = limits.admit()
+        if retry_after is not None:
+            return JSONResponse(
+                {'error': {'message': "Rate limit reached", 'type': 'requests', 'code': 'rate_limit_exceeded'}},
+                status_code=429,
+                headers={'Retry-After': str(retry_after)},
+            )
+        if not body.get('stream'):
+            try:
+                await asyncio.sleep(limits.latency)
+                return JSONResponse(completion(body))
+            finally:
+                limits.in_flight -= 1
+
+        async def chunks():
+            try:
+                for word in "stand-in streamed completion".split():
+                    await asyncio.sleep(limits.latency / 3)
+                    chunk = {
+                        'id': 'chatcmpl-standin', 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                        'model': body.get('model'),
+                        'choices': [{'index': 0, 'delta': {'content': word + ' '}, 'finish_reason': None}],
+                    }
+                    yield f"data: {json.dumps(chunk)}\n\n"
+                yield "data: [DONE]\n\n"
+            finally:
+                limits.in_flight -= 1
+        return StreamingResponse(chunks(), media_type='text/event-stream')
+
+    return Starlette(routes=[Route('/v1/chat/completions', chat_completions, methods=['POST'])])
+
+
+def start_server(limits: StandinLimits, port: int):
+    server = uvicorn.Server(uvicorn.Config(create_app(limits), host='127.0.0.1', port=port, log_level='warning'))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, thread
+
+
+async def burst(calls: int):
+    from pydantic import BaseModel
+    from prompt_models import acall_llm, PromptModel
+
+    async def one(i):
+        try:
+            if i % 2:
+                chunks = await acall_llm(user_prompt=f"task {i}", stream=True)
+                return ''.join([chunk async for chunk in chunks]) and 'ok'
+            result = await acall_llm(user_prompt=f"task {i}", response_model=PromptModel)
+            return 'ok' if isinstance(result, BaseModel) else 'bad'
+        except Exception as e:
+            return type(e).__name__
+
+    results = await asyncio.gather(*(one(i) for i in range(calls)))
+    counts = {}
+    for result in results:
+        counts[result] = counts.get(result, 0) + 1
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--serve', action='store_true', help="only run the stand-in server")
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--server-rps', type=float, default=4, help="requests per second before 429s")
+    parser.add_argument('--server-concurrency', type=int, default=3, help="concurrent requests before 429s")
+    parser.add_argument('--latency', type=float, default=0.2, help="seconds per completion")
+    parser.add_argument('--calls', type=int, default=100, help="calls in the burst")
+    args = parser.parse_args(argv)
+
+    if not args.port:
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            args.port = s.getsockname()[1]
+    limits = StandinLimits(args.server_rps, args.server_concurrency, args.latency)
+
+    if args.serve:
+        uvicorn.run(create_app(limits), host='127.0.0.1', port=args.port)
+        return 0
+
+    # read when prompt_models is first imported (in burst) and its clients first built, so set them before either
+    os.environ['OPENAI_BASE_URL'] = f"http://127.0.0.1:{args.port}/v1"
+    os.environ.setdefault('OPENAI_API_KEY', 'stand-in')
+    os.environ['LLM_CACHE_ENABLED'] = 'false'
+    server, thread = start_server(limits, args.port)
+    from rate_limit import rate_limiter
+
+    started = time.monotonic()
+    try:
+        results = asyncio.run(burst(args.calls))
+    finally:
+        server.should_exit = True
+        thread.join(10)
+    print(json.dumps({
+        'elapsed_s': round(time.monotonic() - started, 3),
+        'client_results': results,
+        'server_responses': limits.counts,
+        'limiter': rate_limiter.stats(),
+    }, indent=2))
+    return 0 if set(results) == {'ok'} else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,143 @@
+import os
+import json
+import time
+import uuid
+import socket
+import asyncio
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Identifies this process's events, so its own tailer skips what it already delivered locally
+ORIGIN = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class BattleEvent:
+    seq: int
+    call_id: str
+    stage: str
+    payload: str
+    origin: str
+    created_at: float
+
+
+class EventLog:
+    '''
+    Battle events shared between worker processes through the database.
+
+    Every published event is appended (through the storage writer, so it's
+    batched with the rest of the writes); each process tails the log for
+    events other processes wrote and hands them to its local subscribers, so
+    a battle running in one worker can be streamed from any other. Old events
+    are pruned after `retention_seconds`.
+
+    `<stage>_partial` events carry the whole output so far, so they're written
+    at most every `partial_interval` seconds per stage, and each one replaces
+    the last; other workers' viewers see streamed text in coarser steps.
+    '''
+    def __init__(self, poll_interval: float = 0.05, retention_seconds: float = 600, partial_interval: float = 0.5):
+        self.poll_interval = poll_interval
+        self.retention_seconds = retention_seconds
+        self.partial_interval = partial_interval
+        self._lock = threading.Lock()
+        self._last_partial = {}  # (call_id, stage) -> when its last partial was written
+        self.storage = None
+        self._last_seq = 0
+        self._task = None
+        self._last_prune = 0.0
+
+    def attach(self, storage):
+        self.storage = storage
+        self.tbl = storage.db.create(BattleEvent, pk='seq', transform=True)
+        self.tbl.create_index(['call_id', 'seq'], if_not_exists=True)
+        self.tbl.create_index(['call_id', 'stage', 'seq'], if_not_exists=True)
+        self.tbl.create_index(['created_at'], if_not_exists=True)
+
+    def append(self, call_id: str, stage: str, payload):
+        now = time.time()
+        row = dict(call_id=call_id, stage=stage, payload=json.dumps(payload), origin=ORIGIN, created_at=now)
+        if not stage.endswith('_partial'):
+            with self._lock:
+                if stage == 'cancelled':
+                    self._last_partial = {key: at for key, at in self._last_partial.items() if key[0] != call_id}
+                else:
+                    self._last_partial.pop((call_id, f"{stage.removesuffix('_failed')}_partial"), None)
+            self.storage.insert(self.tbl.name, row)
+            return
+        with self._lock:
+            if now - self._last_partial.get((call_id, stage), 0) < self.partial_interval:
+                return
+            self._last_partial[(call_id, stage)] = now
+        self.storage.write(_replace_partial, self.tbl.name, row)
+
+    def replay(self, call_id: str):
+        '''Latest payload per stage for call_id, from every process'''
+        rows = self.storage.reader.q(
+            f"SELECT stage, payload FROM {self.tbl.name} WHERE seq IN "
+            f"(SELECT max(seq) FROM {self.tbl.name} WHERE call_id = ? GROUP BY stage) ORDER BY seq", [call_id]
+        )
+        return {row['stage']: json.loads(row['payload']) for row in rows}
+
+    def poll(self, call_ids):
+        '''Events from other processes for call_ids since the last poll, as (call_id, stage, payload)'''
+        latest = self.storage.reader.q(f"SELECT max(seq) AS seq FROM {self.tbl.name}")[0]['seq'] or 0
+        if latest <= self._last_seq:
+            return []
+        rows = []
+        if call_ids:
+            placeholders = ', '.join('?' * len(call_ids))
+            rows = self.storage.reader.q(
+                f"SELECT call_id, stage, payload FROM {self.tbl.name} "
+                f"WHERE seq > ? AND seq <= ? AND origin != ? AND call_id IN ({placeholders}) ORDER BY seq",
+                [self._last_seq, latest, ORIGIN, *call_ids],
+            )
+        self._last_seq = latest
+        return [(row['call_id'], row['stage'], json.loads(row['payload'])) for row in rows]
+
+    async def tail(self, deliver, subscribed_call_ids):
+        '''Poll forever, calling `deliver(call_id, stage, payload)` for other processes' events'''
+        self._last_seq = self.storage.reader.q(f"SELECT max(seq) AS seq FROM {self.tbl.name}")[0]['seq'] or 0
+        while True:
+            try:
+                call_ids = subscribed_call_ids()
+                for call_id, stage, payload in self.poll(call_ids):
+                    deliver(call_id, stage, payload)
+                self._maybe_prune()
+            except Exception:
+                logger.exception("Tailing the event log failed")
+            await asyncio.sleep(self.poll_interval)
+
+    def _maybe_prune(self):
+        now = time.time()
+        if now - self._last_prune < self.retention_seconds / 10:
+            return
+        self._last_prune = now
+        self.storage.write(_prune, self.tbl.name, now - self.retention_seconds)
+
+    def start(self, deliver, subscribed_call_ids):
+        if self._task is None:
+            self._task = asyncio.create_task(self.tail(deliver, subscribed_call_ids))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+def _replace_partial(db, tbl, row):
+    db.execute(f"DELETE FROM {tbl} WHERE call_id = ? AND stage = ?", [row['call_id'], row['stage']])
+    db[tbl].insert(row)
+
+
+def _prune(db, tbl, before):
+    # keep the newest row so seq never goes backwards for the tailers
+    db.execute(f"DELETE FROM {tbl} WHERE created_at < ? AND seq < (SELECT max(seq) FROM {tbl})", [before])
+
+
+event_log = EventLog(
+    poll_interval=float(os.getenv("EVENT_LOG_POLL_INTERVAL", 0.05)),
+    retention_seconds=float(os.getenv("EVENT_LOG_RETENTION", 600)),
+    partial_interval=float(os.getenv("EVENT_LOG_PARTIAL_INTERVAL", 0.5)),
+)
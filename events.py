@@ -0,0 +1,145 @@
+import os
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class WaitersFull(Exception):
+    pass
+
+
+class BattleEvents:
+    '''
+    In-process pub/sub keyed by call_id.
+
+    Generation workers publish a (stage, payload) event whenever a stage finishes;
+    every subscriber for that call_id gets it pushed onto its own asyncio queue.
+    The latest payload per stage is also kept as a snapshot so late subscribers
+    can render the current state without touching the database.
+
+    Connections that only need one stage's final output wait on a shared
+    future instead of a queue (see `waiting_for`), so they don't buffer the
+    stream of partial events and cost the same however many of them there are.
+
+    With an EventLog attached (multi-process serving) events are also appended
+    to it, and events other processes append are delivered to this process's
+    subscribers, so any worker can stream any battle.
+    '''
+    def __init__(self, max_snapshots: int = 2048, max_waiters: int = 4096):
+        self.max_snapshots = max_snapshots
+        self.max_waiters = max_waiters
+        self._lock = threading.Lock()
+        self._subscribers = {}  # call_id -> set of (loop, queue)
+        self._waiters = {}  # call_id -> {stage: [loop, future, connections waiting]}
+        self._waiter_count = 0
+        self._snapshots = OrderedDict()  # call_id -> {stage: payload}
+        self.log = None
+
+    def attach_log(self, log):
+        self.log = log
+
+    def subscribe(self, call_id: str):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        with self._lock:
+            self._subscribers.setdefault(call_id, set()).add((loop, queue))
+        if self.log is not None:
+            self.log.start(self._deliver, self.subscribed_call_ids)
+        return queue
+
+    def subscribed_call_ids(self):
+        with self._lock:
+            return list({*self._subscribers, *self._waiters})
+
+    def unsubscribe(self, call_id: str, queue):
+        with self._lock:
+            subscribers = self._subscribers.get(call_id)
+            if subscribers is None:
+                return
+            subscribers.difference_update({s for s in subscribers if s[1] is queue})
+            if not subscribers:
+                del self._subscribers[call_id]
+
+    @property
+    def waiters_full(self):
+        return self._waiter_count >= self.max_waiters
+
+    @contextmanager
+    def waiting_for(self, call_id: str, stage: str):
+        '''
+        A future resolved with (stage, payload) when `stage` finishes for
+        call_id, with (`<stage>_failed`, error) if it fails, or with
+        ('cancelled', reason) if the battle is cancelled. Everyone waiting on
+        the same stage shares the future (so await it through asyncio.shield);
+        it's dropped when the last of them leaves the block. Raises WaitersFull
+        beyond `max_waiters` connections.
+        '''
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._waiter_count >= self.max_waiters:
+                raise WaitersFull(f"{self._waiter_count} connections already waiting")
+            stages = self._waiters.setdefault(call_id, {})
+            waiter = stages.get(stage)
+            if waiter is None:
+                waiter = stages[stage] = [loop, loop.create_future(), 0]
+            waiter[2] += 1
+            self._waiter_count += 1
+        if self.log is not None:
+            self.log.start(self._deliver, self.subscribed_call_ids)
+        try:
+            yield waiter[1]
+        finally:
+            with self._lock:
+                waiter[2] -= 1
+                self._waiter_count -= 1
+                if waiter[2] == 0 and stages.get(stage) is waiter:
+                    del stages[stage]
+                    if not stages and self._waiters.get(call_id) is stages:
+                        del self._waiters[call_id]
+
+    def publish(self, call_id: str, stage: str, payload=None):
+        '''Safe to call from any thread.'''
+        self._deliver(call_id, stage, payload)
+        if self.log is not None:
+            self.log.append(call_id, stage, payload)
+
+    def _deliver(self, call_id: str, stage: str, payload):
+        with self._lock:
+            snapshot = self._snapshots.setdefault(call_id, {})
+            snapshot[stage] = payload
+            self._snapshots.move_to_end(call_id)
+            while len(self._snapshots) > self.max_snapshots:
+                self._snapshots.popitem(last=False)
+            subscribers = list(self._subscribers.get(call_id, ()))
+            waiting = self._waiters.get(call_id, {})
+            if stage == 'cancelled':
+                waiters = list(waiting.values())
+            else:
+                waiter = waiting.get(stage.removesuffix('_failed'))
+                waiters = [waiter] if waiter is not None else []
+
+        logger.debug(f"Publishing {stage} for call_id: {call_id} to {len(subscribers)} subscribers")
+        for loop, queue in subscribers:
+            loop.call_soon_threadsafe(queue.put_nowait, (stage, payload))
+        for loop, future, _ in waiters:
+            loop.call_soon_threadsafe(_resolve, future, (stage, payload))
+
+    def snapshot(self, call_id: str):
+        with self._lock:
+            snapshot = dict(self._snapshots.get(call_id, {}))
+        if self.log is not None:
+            # stages finished in other processes; local events are at least as fresh
+            snapshot = {**self.log.replay(call_id), **snapshot}
+        return snapshot
+
+
+def _resolve(future, result):
+    if not future.done():
+        future.set_result(result)
+
+
+battle_events = BattleEvents(max_waiters=int(os.getenv("SSE_MAX_WAITERS", 4096)))
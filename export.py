@@ -0,0 +1,150 @@
+'''
+Export generations, each with its battle's grades, as NDJSON.
+
+    python export.py --since 2026-01-01 --call-type o1_output > generations.ndjson
+
+Rows come out in (timestamp, call_id) order, read a page at a time with a
+keyset cursor, so memory stays flat however big the table is and no read
+transaction is held open long enough to hold back the writer's checkpoints.
+Every line carries the `cursor` to resume after it (--cursor, or ?cursor= on
+/export). Rows moved out by archive.py are in its files, not here.
+'''
+import sys
+import json
+import base64
+import logging
+import argparse
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = 500
+
+
+class ExportError(ValueError):
+    '''A filter or cursor that can't be used'''
+
+
+def encode_cursor(timestamp: str, call_id: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([timestamp, call_id]).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str):
+    try:
+        timestamp, call_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except Exception:
+        raise ExportError(f"Invalid cursor: {cursor!r}")
+    return str(timestamp), str(call_id)
+
+
+def _check_date(name: str, value):
+    if value is None:
+        return None
+    try:
+        datetime.fromisoformat(value)
+    except ValueError:
+        raise ExportError(f"{name} must be an ISO date or timestamp, got {value!r}")
+    return value
+
+
+def export_rows(storage, session_id=None, call_type=None, since=None, until=None, cursor=None,
+                limit=None, page_size: int = PAGE_SIZE):
+    '''
+    Generation rows matching the filters, oldest first, each with `grades`
+    (its battle's grades) and `cursor`. `since` is inclusive, `until`
+    exclusive. Filters are checked before the first row is read.
+    '''
+    conditions, params = [], []
+    for column, value in (('session_id', session_id), ('call_type', call_type)):
+        if value is not None:
+            conditions.append(f"{column} = ?")
+            params.append(value)
+    if _check_date('since', since) is not None:
+        conditions.append("timestamp >= ?")
+        params.append(since)
+    if _check_date('until', until) is not None:
+        conditions.append("timestamp < ?")
+        params.append(until)
+    if limit is not None and limit < 0:
+        raise ExportError(f"limit can't be negative, got {limit}")
+    after = decode_cursor(cursor) if cursor else None
+    return _pages(storage, conditions, params, after, limit, page_size)
+
+
+def _pages(storage, conditions, params, after, limit, page_size):
+    exported = 0
+    while limit is None or exported < limit:
+        # looked up per page: a streaming response may pull each page on a different thread
+        reader = storage.reader
+        where = list(conditions)
+        page_params = list(params)
+        if after is not None:
+            where.append("(timestamp, call_id) > (?, ?)")
+            page_params += after
+        size = page_size if limit is None else min(page_size, limit - exported)
+        rows = reader.q(
+            f"SELECT * FROM generation {'WHERE ' + ' AND '.join(where) if where else ''} "
+            f"ORDER BY timestamp, call_id LIMIT ?", page_params + [size]
+        )
+        if not rows:
+            return
+
+        # generation call_ids are `{battle_id}-{stage}`, grades reference the battle_id
+        battle_ids = {_battle_id(row) for row in rows}
+        grades = {}
+        for grade in reader.q(
+            f"SELECT * FROM grade WHERE call_id IN ({', '.join('?' * len(battle_ids))}) ORDER BY timestamp",
+            list(battle_ids),
+        ):
+            grades.setdefault(grade['call_id'], []).append(grade)
+
+        for row in rows:
+            row['grades'] = grades.get(_battle_id(row), [])
+            row['cursor'] = encode_cursor(row['timestamp'], row['call_id'])
+            yield row
+        exported += len(rows)
+        after = (rows[-1]['timestamp'], rows[-1]['call_id'])
+        if len(rows) < size:
+            return
+
+
+def _battle_id(row):
+    suffix = f"-{row['call_type']}"
+    return row['call_id'][:-len(suffix)] if row['call_id'].endswith(suffix) else row['call_id']
+
+
+def to_ndjson(rows):
+    for row in rows:
+        yield json.dumps(row, default=str) + '\n'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--session-id')
+    parser.add_argument('--call-type', help="e.g. o1_output")
+    parser.add_argument('--since', help="ISO date or timestamp, inclusive")
+    parser.add_argument('--until', help="ISO date or timestamp, exclusive")
+    parser.add_argument('--cursor', help="resume after the row this cursor came from")
+    parser.add_argument('--limit', type=int)
+    parser.add_argument('--output', help="write here instead of stdout")
+    args = parser.parse_args(argv)
+
+    from storage import storage, setup_schema
+
+    setup_schema()
+    try:
+        rows = export_rows(storage, session_id=args.session_id, call_type=args.call_type,
+                           since=args.since, until=args.until, cursor=args.cursor, limit=args.limit)
+    except ExportError as e:
+        parser.error(str(e))
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        out.writelines(to_ndjson(rows))
+    finally:
+        if args.output:
+            out.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,141 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+llm_hedges = registry.counter(
+    'prompt_battle_llm_hedges', "Slow LLM calls that got a duplicate request, by model and which one answered",
+    ['model', 'outcome'])
+
+
+class LatencyWindow:
+    '''The last `size` latencies of a model's calls, with percentiles over them'''
+    def __init__(self, size: int = 500):
+        self._samples = deque(maxlen=size)
+        self._sorted = None
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+            self._sorted = None
+
+    def __len__(self):
+        return len(self._samples)
+
+    def percentile(self, q: float):
+        with self._lock:
+            if not self._samples:
+                return None
+            if self._sorted is None:
+                self._sorted = sorted(self._samples)
+            ordered = self._sorted
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Hedger:
+    '''
+    Hedged requests: when a call hasn't returned by the `percentile` latency
+    of its model's recent calls, a duplicate is fired and whichever answers
+    first wins; the other is cancelled. Each call adds `max_hedge_rate` to its
+    model's hedge budget (up to `max_budget`) and each duplicate spends one,
+    so at most that fraction of calls is ever paid for twice. Models with
+    fewer than `min_samples` recorded calls aren't hedged. The window records
+    the winning request's own latency, from when it was sent, never a time
+    cut short by the other request answering first.
+    '''
+    def __init__(self, percentile: float = 0.95, max_hedge_rate: float = 0.05, min_samples: int = 20,
+                 window: int = 500, max_budget: float = 10, enabled: bool = True):
+        self.percentile = percentile
+        self.max_hedge_rate = max_hedge_rate
+        self.min_samples = min_samples
+        self.window_size = window
+        self.max_budget = max_budget
+        self.enabled = enabled
+        self._windows = {}
+        self._budgets = {}
+        self._lock = threading.Lock()
+
+    def window(self, model: str) -> LatencyWindow:
+        with self._lock:
+            window = self._windows.get(model)
+            if window is None:
+                window = self._windows[model] = LatencyWindow(self.window_size)
+            return window
+
+    def hedge_delay(self, model: str):
+        '''Seconds to wait before hedging a call to model, or None to not hedge it'''
+        window = self.window(model)
+        if not self.enabled or len(window) < self.min_samples:
+            return None
+        return window.percentile(self.percentile)
+
+    def _earn(self, model: str):
+        with self._lock:
+            self._budgets[model] = min(self.max_budget, self._budgets.get(model, 0) + self.max_hedge_rate)
+
+    def _spend(self, model: str) -> bool:
+        with self._lock:
+            if self._budgets.get(model, 0) < 1:
+                return False
+            self._budgets[model] -= 1
+            return True
+
+    async def acall(self, model: str, request):
+        '''Await `request()`, a coroutine function, firing a second one if the first is slow'''
+        self._earn(model)
+        delay = self.hedge_delay(model)
+        primary = asyncio.ensure_future(request())
+        attempts = [primary]
+        started = {primary: time.monotonic()}
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait([primary], timeout=delay)
+                if not done:
+                    if self._spend(model):
+                        logger.debug(f"Hedging {model} call after {delay:.3f}s")
+                        hedge = asyncio.ensure_future(request())
+                        attempts.append(hedge)
+                        started[hedge] = time.monotonic()
+                    else:
+                        llm_hedges.inc(model=model, outcome='over_budget')
+
+            pending, error = set(attempts), None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    exc = asyncio.CancelledError() if task.cancelled() else task.exception()
+                    if exc is not None:
+                        error = error or exc
+                        continue
+                    self.window(model).add(time.monotonic() - started[task])
+                    if len(attempts) > 1:
+                        llm_hedges.inc(model=model, outcome='hedge' if task is not primary else 'primary')
+                    return task.result()
+            raise error
+        finally:
+            for task in attempts:
+                task.cancel()
+
+    def stats(self):
+        return {
+            model: {
+                'samples': len(window),
+                'hedge_delay': self.hedge_delay(model),
+                'budget': round(self._budgets.get(model, 0), 2),
+            } for model, window in self._windows.items()
+        }
+
+
+hedger = Hedger(
+    percentile=float(os.getenv("LLM_HEDGE_PERCENTILE", 0.95)),
+    max_hedge_rate=float(os.getenv("LLM_HEDGE_MAX_RATE", 0.05)),
+    min_samples=int(os.getenv("LLM_HEDGE_MIN_SAMPLES", 20)),
+    enabled=os.getenv("LLM_HEDGING", "true").lower() != "false",
+)
@@ -0,0 +1,222 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from datetime import datetime
+
+from archive import archive
+
+logger = logging.getLogger(__name__)
+
+# Score for contender_a: the grade buttons are "A is better" (output-1, contender_a wins),
+# "B is better" (output-2, contender_b wins) and "Tie", for the pair picked on the page
+GRADE_SCORES = {'output-1': 1.0, 'output-2': 0.0, 'tie': 0.5}
+
+# Grades from before contenders were recorded were all o1 vs challenger
+DEFAULT_CONTENDERS = ('o1', 'challenger')
+
+ELO_K = float(os.getenv("LEADERBOARD_ELO_K", 32))
+ELO_BASE = 1000.0
+
+
+class LeaderboardEntry:
+    contender: str
+    rating: float
+    ci_low: float
+    ci_high: float
+    elo: float
+    games: int
+    wins: float
+    fitted_at: str
+
+
+class Leaderboard:
+    '''
+    Ratings for the battle contenders from graders' verdicts.
+
+    Elo is updated in O(1) as each grade arrives. A Bradley-Terry fit with
+    bootstrap confidence intervals is recomputed off the request path every
+    `refit_seconds` when there are new grades, and materialized to the
+    leaderboard table; /leaderboard only ever reads the last fit.
+    '''
+    def __init__(self, refit_seconds: float = 60, bootstrap_rounds: int = 1000, k: float = ELO_K):
+        self.refit_seconds = refit_seconds
+        self.bootstrap_rounds = bootstrap_rounds
+        self.k = k
+        self._lock = threading.Lock()
+        self.elo = {}
+        self.games = {}
+        self.wins = {}
+        self.grades_seen = 0
+        self.grades_fitted = 0
+        # last Bradley-Terry fit: {'fitted_at', 'grades', 'rows': [...]}
+        self.fit = None
+        self._task = None
+        # (archived grade files, their grades), reread only when the files change
+        self._archived = None
+
+    def attach(self, storage):
+        self.storage = storage
+        self.tbl = storage.db.create(LeaderboardEntry, pk='contender', transform=True)
+
+    def _grades(self):
+        '''(a, b, grade) of every grade, archived ones included, oldest first'''
+        live = self.storage.reader.q(
+            "SELECT grade_id, coalesce(contender_a, ?) AS a, coalesce(contender_b, ?) AS b, grade "
+            "FROM grade ORDER BY timestamp", list(DEFAULT_CONTENDERS)
+        )
+        parts = archive.parts('grade')
+        if self._archived is None or self._archived[0] != parts:
+            self._archived = (parts, [
+                {'grade_id': row['grade_id'], 'a': row.get('contender_a') or DEFAULT_CONTENDERS[0],
+                 'b': row.get('contender_b') or DEFAULT_CONTENDERS[1], 'grade': row['grade']}
+                for row in archive.rows('grade')
+            ])
+        # a run interrupted before deleting leaves grades in both places
+        live_ids = {row['grade_id'] for row in live}
+        return [row for row in self._archived[1] if row['grade_id'] not in live_ids] + live
+
+    def _replay(self):
+        '''Rebuild Elo from every stored grade, and pick up the last materialized fit'''
+        for row in self._grades():
+            self.record(row['a'], row['b'], row['grade'])
+        rows = self.storage.reader.q(f"SELECT * FROM {self.tbl.name} ORDER BY rating DESC")
+        if rows:
+            self.fit = {'fitted_at': rows[0]['fitted_at'], 'grades': None, 'rows': rows}
+        logger.debug(f"Replayed {self.grades_seen} grades into the leaderboard")
+
+    def record(self, contender_a: str, contender_b: str, grade: str):
+        '''Elo update for one grade'''
+        score = GRADE_SCORES.get(grade)
+        if score is None:
+            return
+        with self._lock:
+            rating_a = self.elo.setdefault(contender_a, ELO_BASE)
+            rating_b = self.elo.setdefault(contender_b, ELO_BASE)
+            expected_a = 1 / (1 + 10 ** ((rating_b - rating_a) / 400))
+            delta = self.k * (score - expected_a)
+            self.elo[contender_a] = rating_a + delta
+            self.elo[contender_b] = rating_b - delta
+            for contender, won in ((contender_a, score), (contender_b, 1 - score)):
+                self.games[contender] = self.games.get(contender, 0) + 1
+                self.wins[contender] = self.wins.get(contender, 0) + won
+            self.grades_seen += 1
+
+    def elo_table(self):
+        with self._lock:
+            return sorted(
+                ({'contender': c, 'elo': r, 'games': self.games[c], 'wins': self.wins[c]} for c, r in self.elo.items()),
+                key=lambda row: row['elo'], reverse=True,
+            )
+
+    def refit(self):
+        '''Bradley-Terry fit over all grades, materialized to the leaderboard table. Blocking.'''
+        import numpy as np
+        grades = [g for g in self._grades() if g['grade'] in GRADE_SCORES and g['a'] != g['b']]
+        if not grades:
+            return None
+        start = time.perf_counter()
+        contenders = sorted({g['a'] for g in grades} | {g['b'] for g in grades})
+        index = {c: i for i, c in enumerate(contenders)}
+        a = np.array([index[g['a']] for g in grades])
+        b = np.array([index[g['b']] for g in grades])
+        score = np.array([GRADE_SCORES[g['grade']] for g in grades])
+
+        ratings, low, high = bradley_terry_bootstrap(a, b, score, len(contenders), self.bootstrap_rounds)
+        elo = dict((row['contender'], row) for row in self.elo_table())
+        fitted_at = datetime.now().isoformat()
+        rows = sorted((
+            {
+                'contender': contender,
+                'rating': float(ratings[i]),
+                'ci_low': float(low[i]),
+                'ci_high': float(high[i]),
+                'elo': float(elo.get(contender, {}).get('elo', ELO_BASE)),
+                'games': int(elo.get(contender, {}).get('games', 0)),
+                'wins': float(elo.get(contender, {}).get('wins', 0)),
+                'fitted_at': fitted_at,
+            } for contender, i in index.items()
+        ), key=lambda row: row['rating'], reverse=True)
+        self.storage.write(_replace_entries, self.tbl.name, rows)
+        self.fit = {'fitted_at': fitted_at, 'grades': len(grades), 'rows': rows}
+        logger.debug(f"Bradley-Terry fit over {len(grades)} grades in {time.perf_counter() - start:.3f}s")
+        return self.fit
+
+    async def _refit_loop(self):
+        while True:
+            if self.grades_seen != self.grades_fitted:
+                seen = self.grades_seen
+                try:
+                    # numpy work in a thread so the event loop keeps serving requests
+                    await asyncio.to_thread(self.refit)
+                    self.grades_fitted = seen
+                except Exception:
+                    logger.exception("Leaderboard refit failed")
+            await asyncio.sleep(self.refit_seconds)
+
+    async def start(self):
+        if self._task is None:
+            self._replay()
+            self._task = asyncio.create_task(self._refit_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+def _replace_entries(db, tbl, rows):
+    db.execute(f"DELETE FROM {tbl}")
+    db[tbl].insert_all(rows)
+
+
+def bradley_terry_bootstrap(a, b, score, n_contenders: int, rounds: int = 1000, prior: float = 0.5,
+                            iterations: int = 200, seed: int = 0):
+    '''
+    Bradley-Terry strengths on the Elo scale for games a[g] vs b[g] where a
+    scored score[g] (1 win, 0.5 tie, 0 loss), with a 95% bootstrap interval.
+
+    The games are collapsed into (pair, outcome) cells, so each bootstrap round
+    is one multinomial draw over the cells rather than a resample of every
+    game, and all rounds are fitted at once with vectorized MM updates
+    (Hunter 2004). `prior` is added to the wins each way between every pair
+    (0.5 makes one virtual tie), which keeps undefeated contenders finite.
+    '''
+    # imported here so the app doesn't pay for numpy until the first fit
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    cells, counts = np.unique(np.stack([a, b, score]), axis=1, return_counts=True)
+    cell_a, cell_b, cell_score = cells[0].astype(int), cells[1].astype(int), cells[2]
+
+    # row 0 is the observed data, the rest are bootstrap resamples
+    resampled = rng.multinomial(counts.sum(), counts / counts.sum(), size=rounds)
+    weights = np.vstack([counts, resampled]).astype(float)  # (rounds + 1, cells)
+
+    # wins[r, i, j]: games i won against j in round r, ties counting half to each side
+    wins = np.zeros((rounds + 1, n_contenders, n_contenders))
+    np.add.at(wins, (slice(None), cell_a, cell_b), weights * cell_score)
+    np.add.at(wins, (slice(None), cell_b, cell_a), weights * (1 - cell_score))
+    off_diagonal = 1 - np.eye(n_contenders)
+    wins += prior * off_diagonal
+
+    games = wins + wins.transpose(0, 2, 1)
+    total_wins = wins.sum(axis=2)
+    strength = np.ones((rounds + 1, n_contenders))
+    for _ in range(iterations):
+        pair_sum = strength[:, :, None] + strength[:, None, :]
+        strength = total_wins / (games / pair_sum).sum(axis=2)
+        # pin the geometric mean at 1 so rounds are comparable
+        strength /= np.exp(np.log(strength).mean(axis=1, keepdims=True))
+
+    ratings = ELO_BASE + 400 * np.log10(strength)
+    low, high = np.percentile(ratings[1:], [2.5, 97.5], axis=0)
+    return ratings[0], low, high
+
+
+leaderboard = Leaderboard(
+    refit_seconds=float(os.getenv("LEADERBOARD_REFIT_SECONDS", 60)),
+    bootstrap_rounds=int(os.getenv("LEADERBOARD_BOOTSTRAP_ROUNDS", 1000)),
+)
@@ -0,0 +1,137 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class BattleLiveness:
+    '''
+    When a client last showed interest in each unfinished battle: a poll, or
+    an open SSE connection (which heartbeats). Battles nobody has looked at
+    for `timeout` seconds are handed to the abandoned handler to be cancelled.
+
+    Only battles started in this process are watched. With a storage attached
+    (multi-process serving) heartbeats are also written to the battle row,
+    throttled, so a client polling or streaming through another worker keeps
+    the battle alive here; a battle another worker marked cancelled is
+    handed over on the next check.
+    '''
+    def __init__(self, timeout: float = 30, check_interval: float = 5):
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self.heartbeat_interval = timeout / 3
+        self._lock = threading.Lock()
+        self._last_seen = {}  # call_id -> time.time() of the last sign of a client
+        self._connections = {}  # call_id -> open SSE streams in this process
+        self._last_shared = {}  # call_id -> when a heartbeat was last written to the db
+        self._on_abandoned = None
+        self.storage = None
+        self._task = None
+
+    def attach(self, storage):
+        self.storage = storage
+
+    def on_abandoned(self, handler):
+        '''`handler(call_id)` is called for each battle whose client went away'''
+        self._on_abandoned = handler
+
+    def watch(self, call_id: str):
+        with self._lock:
+            self._last_seen[call_id] = time.time()
+
+    def touch(self, call_id: str):
+        now = time.time()
+        with self._lock:
+            if call_id in self._last_seen:
+                self._last_seen[call_id] = now
+            if self.storage is None or now - self._last_shared.get(call_id, 0) < self.heartbeat_interval:
+                return
+            self._last_shared[call_id] = now
+        self.storage.write(_touch_battle, call_id, now)
+
+    def connect(self, call_id: str):
+        self.touch(call_id)
+        with self._lock:
+            self._connections[call_id] = self._connections.get(call_id, 0) + 1
+
+    def disconnect(self, call_id: str):
+        with self._lock:
+            remaining = self._connections.get(call_id, 0) - 1
+            if remaining > 0:
+                self._connections[call_id] = remaining
+            else:
+                self._connections.pop(call_id, None)
+        self.touch(call_id)
+
+    def forget(self, call_id: str):
+        '''Stop watching call_id, e.g. because it finished'''
+        with self._lock:
+            self._last_seen.pop(call_id, None)
+            self._last_shared.pop(call_id, None)
+
+    def abandoned(self):
+        '''Watched call_ids with no connection and no sign of a client for `timeout` seconds'''
+        now = time.time()
+        with self._lock:
+            watched = {
+                call_id: seen for call_id, seen in self._last_seen.items() if call_id not in self._connections
+            }
+            self._last_shared = {call_id: at for call_id, at in self._last_shared.items() if now - at < self.timeout}
+        stale = [call_id for call_id, seen in watched.items() if now - seen > self.timeout]
+        if self.storage is None or not watched:
+            return stale
+
+        # other workers may have heard from the client, or cancelled the battle
+        placeholders = ', '.join('?' * len(watched))
+        rows = self.storage.reader.q(
+            f"SELECT battle_id, status, last_seen_at FROM battle WHERE battle_id IN ({placeholders})", list(watched)
+        )
+        shared = {row['battle_id']: row for row in rows}
+        result = []
+        for call_id in watched:
+            row = shared.get(call_id, {})
+            if row.get('status') == 'cancelled':
+                result.append(call_id)
+            elif call_id in stale:
+                if (row.get('last_seen_at') or 0) > now - self.timeout:
+                    with self._lock:
+                        if call_id in self._last_seen:
+                            self._last_seen[call_id] = row['last_seen_at']
+                else:
+                    result.append(call_id)
+        return result
+
+    async def _check_loop(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            try:
+                for call_id in self.abandoned():
+                    logger.debug(f"No client for call_id: {call_id}, cancelling")
+                    self.forget(call_id)
+                    if self._on_abandoned is not None:
+                        self._on_abandoned(call_id)
+            except Exception:
+                logger.exception("Checking battle liveness failed")
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._check_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+def _touch_battle(db, battle_id, seen_at):
+    db.execute("UPDATE battle SET last_seen_at = ? WHERE battle_id = ?", [seen_at, battle_id])
+
+
+liveness = BattleLiveness(
+    timeout=float(os.getenv("BATTLE_LIVENESS_TIMEOUT", 30)),
+    check_interval=float(os.getenv("BATTLE_LIVENESS_CHECK_INTERVAL", 5)),
+)
@@ -0,0 +1,268 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import inspect
+import logging
+import functools
+import threading
+from collections import OrderedDict
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+
+class LLMCacheEntry:
+    key: str
+    model_name: str
+    value: str
+    created_at: float
+    last_access: float
+
+
+@functools.lru_cache(maxsize=None)
+def schema_hash(response_model) -> str:
+    if response_model is None:
+        return ""
+    schema = json.dumps(response_model.model_json_schema(), sort_keys=True)
+    return hashlib.sha256(schema.encode()).hexdigest()
+
+
+class ResponseCache:
+    '''
+    Exact-match cache for LLM responses: an in-memory LRU in front of a SQLite
+    table living in the app's Database, written through the storage writer. Entries expire after `ttl_seconds` and
+    the table is pruned back to `max_entries` by least recent access.
+    '''
+    def __init__(self, max_memory_entries: int = 1024, max_entries: int = 100_000,
+                 ttl_seconds: float = 7 * 24 * 3600, enabled: bool = True):
+        self.max_memory_entries = max_memory_entries
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled
+        self._memory = OrderedDict()  # key -> (value, created_at)
+        self._lock = threading.Lock()
+        self._storage = None
+        self._tbl = None
+        self._sets_since_prune = 0
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+    def attach(self, storage):
+        '''Persist entries through `storage` (see storage.Storage)'''
+        self._storage = storage
+        self._tbl = storage.db.create(LLMCacheEntry, pk='key', transform=True)
+        self._tbl.create_index(['last_access'], if_not_exists=True)
+
+    @staticmethod
+    def make_key(namespace: str, model_name: str, system_prompt: str, user_prompt: str, response_model=None,
+                 stream: bool = False) -> str:
+        parts = [namespace, model_name, system_prompt, user_prompt, schema_hash(response_model)]
+        if stream:
+            # streamed calls cache plain text, which mustn't be handed to a response_model
+            parts.append('stream')
+        return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+    def get(self, key: str):
+        '''Cached value for key, or None on a miss'''
+        now = time.time()
+        value = self._from_memory(key, now)
+        return value if value is not None else self._from_db(key, now)
+
+    async def aget(self, key: str):
+        '''get() for coroutines: a database lookup runs on a worker thread, off the event loop'''
+        now = time.time()
+        value = self._from_memory(key, now)
+        if value is not None or self._tbl is None:
+            return value if value is not None else self._from_db(key, now)
+        return await asyncio.to_thread(self._from_db, key, now)
+
+    def _from_memory(self, key: str, now: float):
+        # the lock only guards the in-memory LRU, so lookups never queue behind a db read
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and now - entry[1] < self.ttl_seconds:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self._memory.pop(key, None)
+        return None
+
+    def _from_db(self, key: str, now: float):
+        rows = []
+        if self._tbl is not None:
+            rows = self._storage.reader.q(
+                f"select value, created_at from {self._tbl.name} where key = ? and created_at > ?",
+                [key, now - self.ttl_seconds],
+            )
+        if not rows:
+            with self._lock:
+                self.misses += 1
+            return None
+        value = rows[0]['value']
+        self._storage.write(_touch, self._tbl.name, key, now)
+        with self._lock:
+            self._remember(key, value, rows[0]['created_at'])
+            self.hits += 1
+            self.db_hits += 1
+        return value
+
+    def set(self, key: str, value: str, model_name: str = ""):
+        now = time.time()
+        with self._lock:
+            self._remember(key, value, now)
+            if self._tbl is None:
+                return
+            self._sets_since_prune += 1
+            prune = self._sets_since_prune >= 100
+            if prune:
+                self._sets_since_prune = 0
+        self._storage.write(_upsert, self._tbl.name,
+                            dict(key=key, model_name=model_name, value=value, created_at=now, last_access=now))
+        if prune:
+            self._storage.write(_prune, self._tbl.name, now - self.ttl_seconds, self.max_entries)
+
+    def _remember(self, key, value, created_at):
+        self._memory[key] = (value, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'db_hits': self.db_hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'memory_entries': len(self._memory),
+        }
+
+
+def _touch(db, tbl, key, now):
+    db.execute(f"update {tbl} set last_access = ? where key = ?", [now, key])
+
+
+def _upsert(db, tbl, row):
+    db[tbl].upsert(row, pk='key')
+
+
+def _prune(db, tbl, expired_before, max_entries):
+    db.execute(f"delete from {tbl} where created_at <= ?", [expired_before])
+    db.execute(
+        f"delete from {tbl} where key in "
+        f"(select key from {tbl} order by last_access desc limit -1 offset ?)",
+        [max_entries],
+    )
+
+
+response_cache = ResponseCache(
+    max_memory_entries=int(os.getenv("LLM_CACHE_MEMORY_ENTRIES", 1024)),
+    max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", 100_000)),
+    ttl_seconds=float(os.getenv("LLM_CACHE_TTL", 7 * 24 * 3600)),
+    enabled=os.getenv("LLM_CACHE_ENABLED", "true").lower() != "false",
+)
+
+registry.counter('prompt_battle_llm_cache_hits', "LLM calls answered from the response cache", fn=lambda: response_cache.hits)
+registry.counter('prompt_battle_llm_cache_db_hits', "Cache hits that had to read the database", fn=lambda: response_cache.db_hits)
+registry.counter('prompt_battle_llm_cache_misses', "LLM calls the response cache couldn't answer", fn=lambda: response_cache.misses)
+
+
+def _serialize(result, response_model):
+    if isinstance(result, str):
+        return result
+    if response_model is not None and isinstance(result, response_model):
+        return result.model_dump_json()
+    return None
+
+
+def _deserialize(value, response_model):
+    if response_model is not None:
+        return response_model.model_validate_json(value)
+    return value
+
+
+def cached_llm_call(namespace: str, cache: ResponseCache = response_cache):
+    '''
+    Cache a call_llm-style function on (namespace, model_name, system_prompt,
+    user_prompt, response_model schema, whether it streams). The wrapped function must accept
+    `use_cache`; passing use_cache=False bypasses the cache for that call.
+    Streaming calls are cached on their full text and replayed as one chunk.
+    '''
+    def decorator(fn):
+        signature = inspect.signature(fn)
+
+        def prepare(args, kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            call = bound.arguments
+            if not (cache.enabled and call.get('use_cache', True)):
+                return call, None
+            return call, cache.make_key(namespace, call['model_name'], call['system_prompt'], call['user_prompt'],
+                                        call.get('response_model'), bool(call.get('stream')))
+
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                call, key = prepare(args, kwargs)
+                value = await cache.aget(key) if key is not None else None
+                if value is not None:
+                    if call.get('stream'):
+                        return _replay_async(value)
+                    return _deserialize(value, call.get('response_model'))
+
+                result = await fn(*args, **kwargs)
+                if key is None:
+                    return result
+                if call.get('stream'):
+                    return _record_async(result, lambda text: cache.set(key, text, call['model_name']))
+                value = _serialize(result, call.get('response_model'))
+                if value is not None:
+                    cache.set(key, value, call['model_name'])
+                return result
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            call, key = prepare(args, kwargs)
+            value = cache.get(key) if key is not None else None
+            if value is not None:
+                if call.get('stream'):
+                    return iter([value])
+                return _deserialize(value, call.get('response_model'))
+
+            result = fn(*args, **kwargs)
+            if key is None:
+                return result
+            if call.get('stream'):
+                return _record(result, lambda text: cache.set(key, text, call['model_name']))
+            value = _serialize(result, call.get('response_model'))
+            if value is not None:
+                cache.set(key, value, call['model_name'])
+            return result
+        return wrapper
+    return decorator
+
+
+async def _replay_async(value):
+    yield value
+
+
+def _record(chunks, on_complete):
+    # Only a fully consumed stream is cached
+    parts = []
+    for chunk in chunks:
+        parts.append(chunk)
+        yield chunk
+    on_complete(''.join(parts))
+
+
+async def _record_async(chunks, on_complete):
+    parts = []
+    async for chunk in chunks:
+        parts.append(chunk)
+        yield chunk
+    on_complete(''.join(parts))
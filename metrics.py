@@ -0,0 +1,178 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# Default latency buckets in seconds, from a fast render up to a slow LLM call
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _label_key(labelnames, labels):
+    if set(labels) != set(labelnames):
+        raise ValueError(f"Expected labels {labelnames}, got {tuple(labels)}")
+    return tuple(str(labels[name]) for name in labelnames)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labelnames, key, extra=()):
+    pairs = list(zip(labelnames, key)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    '''Base for counters and gauges; pass `fn` to read an unlabelled value at scrape time instead'''
+    type = None
+    suffix = ''
+
+    def __init__(self, name: str, help: str, labelnames=(), fn=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.fn = fn
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(_label_key(self.labelnames, labels), 0)
+
+    def header(self):
+        name = self.name + self.suffix
+        return [f"# HELP {name} {self.help}", f"# TYPE {name} {self.type}"]
+
+    def render(self):
+        name = self.name + self.suffix
+        if self.fn is not None:
+            return self.header() + [f"{name} {_format_value(self.fn())}"]
+        with self._lock:
+            values = list(self._values.items())
+        return self.header() + [
+            f"{name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in values
+        ]
+
+
+class Counter(Metric):
+    type = 'counter'
+    suffix = '_total'
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    '''
+    Cumulative-bucket histogram. Observing is a bisect and two additions under a
+    lock; bucket counts are only summed up when /metrics is scraped.
+    '''
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = _label_key(self.labelnames, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                # per-bucket counts (last one is +Inf), sum
+                series = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        lines = self.header()
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, [('le', _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames=(), fn=None):
+        return self.register(Counter(name, help, labelnames, fn))
+
+    def gauge(self, name: str, help: str, labelnames=(), fn=None):
+        return self.register(Gauge(name, help, labelnames, fn))
+
+    def histogram(self, name: str, help: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def render(self):
+        '''Everything in the Prometheus text exposition format'''
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+queue_wait_seconds = registry.histogram(
+    'prompt_battle_queue_wait_seconds', "Time a battle waited in the generation queue for a worker")
+llm_call_seconds = registry.histogram(
+    'prompt_battle_llm_call_seconds', "LLM call latency, streamed calls timed to the last token",
+    ['model', 'call_type'])
+llm_errors = registry.counter(
+    'prompt_battle_llm_errors', "LLM calls that raised", ['model', 'call_type'])
+db_write_batch_seconds = registry.histogram(
+    'prompt_battle_db_write_batch_seconds', "Time to commit one batch of queued database writes")
+db_writes = registry.counter(
+    'prompt_battle_db_writes', "Database writes committed by the writer thread")
+render_seconds = registry.histogram(
+    'prompt_battle_render_seconds', "Time to render battle state HTML", ['view'])
+battles_in_flight = registry.gauge(
+    'prompt_battle_battles_in_flight', "Battles currently generating")
+battles_finished = registry.counter(
+    'prompt_battle_battles', "Battles that finished running", ['status'])
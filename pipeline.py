@@ -0,0 +1,68 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class UpstreamFailed(Exception):
+    pass
+
+
+class Pipeline:
+    '''
+    Small DAG executor. Each stage is an async function that receives the
+    outputs of the stages it depends on as keyword arguments, and starts as
+    soon as those are done, so independent branches run concurrently and never
+    wait on each other. A failed stage fails its dependents but not other branches.
+    '''
+    def __init__(self):
+        self.stages = {}
+
+    def add_stage(self, name: str, fn, depends_on=()):
+        for dependency in depends_on:
+            if dependency not in self.stages:
+                raise ValueError(f"Stage {name} depends on unknown stage {dependency}")
+        self.stages[name] = (fn, tuple(depends_on))
+        return self
+
+    async def run(self, on_stage_failed=None):
+        '''
+        Run every stage, returning {stage: output} for those that succeeded.
+        `on_stage_failed(name, exc)` is called for each stage that failed or was skipped.
+        '''
+        tasks = {}
+
+        async def run_stage(name):
+            fn, depends_on = self.stages[name]
+            inputs = {}
+            for dependency in depends_on:
+                try:
+                    inputs[dependency] = await tasks[dependency]
+                except Exception as e:
+                    raise UpstreamFailed(f"{dependency} failed") from e
+            return await fn(**inputs)
+
+        # stages are added in dependency order, so every dependency's task exists first
+        for name in self.stages:
+            tasks[name] = asyncio.create_task(run_stage(name), name=name)
+
+        try:
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+        except asyncio.CancelledError:
+            for task in tasks.values():
+                task.cancel()
+            # let the stages unwind (closing their LLM requests) before reporting the cancellation
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            raise
+
+        results = {}
+        for name, task in tasks.items():
+            exc = asyncio.CancelledError(f"{name} cancelled") if task.cancelled() else task.exception()
+            if exc is None:
+                results[name] = task.result()
+                continue
+            if not isinstance(exc, UpstreamFailed):
+                logger.error(f"Stage {name} failed", exc_info=exc)
+            if on_stage_failed is not None:
+                on_stage_failed(name, exc)
+        return results
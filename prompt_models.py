@@ -1,10 +1,16 @@
 import os
-import openai
-import weave
+import re
+import inspect
+import functools
 from pydantic import BaseModel
 from dotenv import load_dotenv
-import instructor
 import time
+import asyncio
+import threading
+
+from llm_cache import cached_llm_call
+from rate_limit import rate_limiter
+from hedging import hedger
 
 import logging
 
@@ -44,50 +50,315 @@ class PromptModel(BaseModel):
     user_prompt: str
 
 
-client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-client = instructor.from_openai(client)
+# openai, instructor and weave take seconds to import, so they're only imported
+# (and the clients built) on first use; prewarm() does it in the background.
+
+@functools.lru_cache(maxsize=None)
+def get_client():
+    import openai
+    import instructor
+    # max_retries=0: rate_limit owns retries, so 429s aren't retried by two layers at once
+    return instructor.from_openai(openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0))
+
+
+# Async client shares one keep-alive connection pool across all concurrent calls
+ASYNC_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", 100))
+
+
+@functools.lru_cache(maxsize=None)
+def get_async_client():
+    import httpx
+    import openai
+    import instructor
+    return instructor.from_openai(openai.AsyncOpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        max_retries=0,
+        http_client=openai.DefaultAsyncHttpxClient(
+            limits=httpx.Limits(
+                max_connections=ASYNC_MAX_CONNECTIONS,
+                max_keepalive_connections=ASYNC_MAX_CONNECTIONS,
+                keepalive_expiry=60,
+            ),
+        ),
+    ))
+
+
+def __getattr__(name):
+    # prompt_models.client / async_client still work, built on first access
+    if name == 'client':
+        return get_client()
+    if name == 'async_client':
+        return get_async_client()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+_weave_ops = {}
+# set once weave is imported; until then async calls run untraced rather than wait for it
+_weave_ready = threading.Event()
+_weave_loading = threading.Lock()
+_weave_loader = None
+
+
+def _weave_op(fn):
+    op = _weave_ops.get(fn)
+    if op is None:
+        import weave
+        _weave_ready.set()
+        op = _weave_ops[fn] = weave.op(fn)
+    return op
+
+
+def _import_weave():
+    try:
+        import weave  # noqa: F401
+        _weave_ready.set()
+    except Exception:
+        logger.exception("Importing weave failed")
+
+
+def load_weave():
+    '''Import weave on a background thread, once'''
+    global _weave_loader
+    with _weave_loading:
+        if _weave_loader is None:
+            _weave_loader = threading.Thread(target=_import_weave, name='weave-import', daemon=True)
+            _weave_loader.start()
+
 
+def traced(fn):
+    '''
+    weave.op, applied on the first call so importing this module doesn't
+    import weave. Async calls made before weave has loaded (see load_weave)
+    run untraced instead of blocking the event loop on the import.
+    '''
+    if inspect.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def async_wrapper(*args, **kwargs):
+            op = _weave_ops.get(fn)
+            if op is None:
+                if not _weave_ready.is_set():
+                    load_weave()
+                    return await fn(*args, **kwargs)
+                op = _weave_op(fn)
+            return await op(*args, **kwargs)
+        return async_wrapper
 
-@weave.op
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        return _weave_op(fn)(*args, **kwargs)
+    return wrapper
+
+
+def prewarm(clients: bool = True):
+    '''
+    Import the LLM libraries and build the clients on background threads, off
+    the startup path. The clients are left alone without `clients` (the dummy
+    backend never uses them) or without an OPENAI_API_KEY to build them with.
+    '''
+    load_weave()
+    if not clients or not os.getenv("OPENAI_API_KEY"):
+        return
+
+    def warm():
+        try:
+            get_client()
+            get_async_client()
+        except Exception:
+            logger.exception("Prewarming LLM clients failed")
+    threading.Thread(target=warm, name='llm-prewarm', daemon=True).start()
+
+
+def dummy_output(system_prompt: str, user_prompt: str, model_name: str):
+    return f"dummy_{model_name}_output_{system_prompt[:10]}_{user_prompt[:10]}"
+
+
+def stream_dummy_llm(system_prompt: str, user_prompt: str, model_name: str, sleep_time: float = 0):
+    # Emit the dummy output word by word, spreading sleep_time across the tokens
+    tokens = re.findall(r"\S+\s*", dummy_output(system_prompt, user_prompt, model_name)) or [""]
+    for token in tokens:
+        if sleep_time > 0:
+            time.sleep(sleep_time / len(tokens))
+        yield token
+
+
+async def astream_dummy_llm(system_prompt: str, user_prompt: str, model_name: str, sleep_time: float = 0):
+    tokens = re.findall(r"\S+\s*", dummy_output(system_prompt, user_prompt, model_name)) or [""]
+    for token in tokens:
+        if sleep_time > 0:
+            await asyncio.sleep(sleep_time / len(tokens))
+        yield token
+
+
+@traced
+@cached_llm_call("dummy")
 def call_dummy_llm(
     system_prompt: str = "",
     user_prompt: str = "",
     model_name: str = "gpt-4o-mini",
     response_model: BaseModel = None,
     sleep_time: float = 0,
+    stream: bool = False,
+    use_cache: bool = True,
 ):
+    if stream:
+        return stream_dummy_llm(system_prompt, user_prompt, model_name, sleep_time)
     if sleep_time > 0:
         logger.debug(f"Sleeping for {sleep_time} seconds")
         time.sleep(sleep_time)
     return PromptModel(
         original_input_user_prompt=user_prompt,
         system_prompt=system_prompt,
-        user_prompt=f"dummy_{model_name}_output_{system_prompt[:10]}_{user_prompt[:10]}",
+        user_prompt=dummy_output(system_prompt, user_prompt, model_name),
     )
 
 
-@weave.op
-def call_llm(system_prompt: str = "",
-              user_prompt: str = "",
-              model_name: str = "gpt-4o-mini",
-              response_model: BaseModel = None,
-            #   temperature: float = None,
-              ):
+@traced
+@cached_llm_call("dummy")
+async def acall_dummy_llm(
+    system_prompt: str = "",
+    user_prompt: str = "",
+    model_name: str = "gpt-4o-mini",
+    response_model: BaseModel = None,
+    sleep_time: float = 0,
+    stream: bool = False,
+    use_cache: bool = True,
+):
+    '''
+    sleep_time can also be a callable drawing a latency per attempt: slow calls
+    are hedged like acall_llm's, inside the cache, so hits never count as latency.
+    '''
+    if stream:
+        return astream_dummy_llm(system_prompt, user_prompt, model_name,
+                                 sleep_time() if callable(sleep_time) else sleep_time)
+
+    async def attempt():
+        seconds = sleep_time() if callable(sleep_time) else sleep_time
+        if seconds > 0:
+            logger.debug(f"Sleeping for {seconds} seconds")
+            await asyncio.sleep(seconds)
+        return PromptModel(
+            original_input_user_prompt=user_prompt,
+            system_prompt=system_prompt,
+            user_prompt=dummy_output(system_prompt, user_prompt, model_name),
+        )
+
+    return await hedger.acall(model_name, attempt)
+
+
+def build_messages(system_prompt: str, user_prompt: str, model_name: str):
     messages = [
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": user_prompt},
     ]
 
+    # o1 models don't accept a system message
     if "o1" in model_name:
         messages.pop(0)
+    return messages
+
+
+def stream_chat(messages, model_name: str):
+    # Plain openai client: instructor doesn't stream free-form text
+    limiter = rate_limiter.for_model(model_name)
+    response = limiter.call(
+        lambda: get_client().client.chat.completions.create(
+            model=model_name,
+            messages=messages,
+            stream=True,
+        ),
+        tokens=rate_limiter.estimate_tokens(messages),
+        keep_slot=True,
+    )
+    # the concurrency slot is held until the stream is read to the end
+    try:
+        for chunk in response:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    finally:
+        limiter.release()
+
+
+async def astream_chat(messages, model_name: str):
+    limiter = rate_limiter.for_model(model_name)
+    response = await limiter.acall(
+        lambda: get_async_client().client.chat.completions.create(
+            model=model_name,
+            messages=messages,
+            stream=True,
+        ),
+        tokens=rate_limiter.estimate_tokens(messages),
+        keep_slot=True,
+    )
+    try:
+        async for chunk in response:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    finally:
+        try:
+            # closes the connection, so a cancelled battle stops the generation upstream too
+            await response.close()
+        finally:
+            limiter.release()
+
+
+@traced
+@cached_llm_call("openai")
+def call_llm(system_prompt: str = "",
+              user_prompt: str = "",
+              model_name: str = "gpt-4o-mini",
+              response_model: BaseModel = None,
+            #   temperature: float = None,
+              stream: bool = False,
+              use_cache: bool = True,
+              ):
+    '''
+    With stream=True returns an iterator of text deltas instead of the full
+    completion; response_model is ignored in that case. Responses are cached
+    (see llm_cache), use_cache=False skips the cache for this call.
+    '''
+    messages = build_messages(system_prompt, user_prompt, model_name)
+    if stream:
+        return stream_chat(messages, model_name)
 
-    response = client.chat.completions.create(
-        model=model_name,
-        messages=messages,
-        response_model=response_model,
-        # temperature=temperature,
+    response = rate_limiter.for_model(model_name).call(
+        lambda: get_client().chat.completions.create(
+            model=model_name,
+            messages=messages,
+            response_model=response_model,
+            # temperature=temperature,
+        ),
+        tokens=rate_limiter.estimate_tokens(messages),
     )
     if response_model is not None:
         return response
     else:
         return response.choices[0].message.content
+
+
+@traced
+@cached_llm_call("openai")
+async def acall_llm(system_prompt: str = "",
+                    user_prompt: str = "",
+                    model_name: str = "gpt-4o-mini",
+                    response_model: BaseModel = None,
+                    stream: bool = False,
+                    use_cache: bool = True,
+                    ):
+    '''Async call_llm, with stream=True returns an async iterator of text deltas'''
+    messages = build_messages(system_prompt, user_prompt, model_name)
+    if stream:
+        return astream_chat(messages, model_name)
+
+    # slow calls get a duplicate request, each going through the rate limiter on its own
+    response = await hedger.acall(model_name, lambda: rate_limiter.for_model(model_name).acall(
+        lambda: get_async_client().chat.completions.create(
+            model=model_name,
+            messages=messages,
+            response_model=response_model,
+        ),
+        tokens=rate_limiter.estimate_tokens(messages),
+    ))
+    if response_model is not None:
+        return response
+    else:
+        return response.choices[0].message.content
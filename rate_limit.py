@@ -0,0 +1,340 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import threading
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+llm_retries = registry.counter(
+    'prompt_battle_llm_retries', "LLM requests retried, by model and reason", ['model', 'reason'])
+llm_rate_limit_wait_seconds = registry.histogram(
+    'prompt_battle_llm_rate_limit_wait_seconds', "Time an LLM request waited on the client-side limiter", ['model'])
+llm_concurrency_limit = registry.gauge(
+    'prompt_battle_llm_concurrency_limit', "Current adaptive concurrency limit", ['model'])
+
+
+class TokenBucket:
+    '''
+    Refills `rate` tokens per second up to `capacity`. `reserve` takes the tokens
+    straight away, going into debt if needed, and returns how long the caller
+    has to wait for them, so waiting callers are served in order.
+    '''
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float = 1) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # a request bigger than the bucket would wait forever, let it through once the bucket is full
+            self._tokens -= min(amount, self.capacity)
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+
+class AdaptiveConcurrency:
+    '''
+    AIMD limit on concurrent requests: each success raises the limit by about one
+    per window of `limit` requests, a rate limit halves it (at most once per
+    `cooldown` seconds, so a burst of 429s from the same window counts once).
+    Usable from threads and from coroutines.
+    '''
+    def __init__(self, initial: int, minimum: int = 1, maximum: int = 64, decrease: float = 0.5, cooldown: float = 1.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+        # threading.Event for blocked threads, (loop, future) for waiting coroutines
+        self._waiters = deque()
+
+    def acquire_sync(self):
+        with self._lock:
+            if self.in_flight < int(self.limit) and not self._waiters:
+                self.in_flight += 1
+                return
+            event = threading.Event()
+            self._waiters.append(event)
+        event.wait()
+
+    async def acquire(self):
+        with self._lock:
+            if self.in_flight < int(self.limit) and not self._waiters:
+                self.in_flight += 1
+                return
+            loop = asyncio.get_running_loop()
+            waiter = (loop, loop.create_future())
+            self._waiters.append(waiter)
+        try:
+            await waiter[1]
+        except asyncio.CancelledError:
+            with self._lock:
+                queued = waiter in self._waiters
+                if queued:
+                    self._waiters.remove(waiter)
+            # otherwise a slot was already handed over: if _wake already gave it to us
+            # (the cancellation landed before we resumed) it's ours to give back,
+            # if not, _wake finds the future cancelled and gives it back itself
+            if not queued and waiter[1].done() and not waiter[1].cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+            self._hand_over()
+
+    def on_success(self):
+        with self._lock:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._hand_over()
+
+    def on_overload(self):
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_decrease < self.cooldown:
+                return
+            self._last_decrease = now
+            self.limit = max(self.minimum, self.limit * self.decrease)
+            logger.debug(f"Concurrency limit cut to {self.limit:.1f}")
+
+    def _hand_over(self):
+        # called with the lock held: give free slots to waiters in arrival order
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.popleft()
+            self.in_flight += 1
+            if isinstance(waiter, threading.Event):
+                waiter.set()
+            else:
+                loop, future = waiter
+                loop.call_soon_threadsafe(self._wake, future)
+
+    def _wake(self, future):
+        if future.done():
+            # the waiter was cancelled after being given the slot
+            self.release()
+        else:
+            future.set_result(None)
+
+
+def _root_cause(exc):
+    '''The provider error behind wrappers like instructor's retry exception'''
+    # openai is imported lazily by prompt_models; if it isn't loaded yet, no error can be one of its
+    openai = sys.modules.get('openai')
+    if openai is None:
+        return None
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        if isinstance(exc, openai.APIError):
+            return exc
+        seen.add(id(exc))
+        exc = exc.__cause__ or exc.__context__
+    return None
+
+
+def retry_after(exc) -> float:
+    '''Seconds the provider asked us to wait (Retry-After / retry-after-ms), or None'''
+    response = getattr(exc, 'response', None)
+    if response is None:
+        return None
+    headers = response.headers
+    if headers.get('retry-after-ms'):
+        try:
+            return float(headers['retry-after-ms']) / 1000
+        except ValueError:
+            pass
+    value = headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def classify(exc):
+    '''Retry reason for a failed request, or None if it shouldn't be retried'''
+    cause = _root_cause(exc)
+    if cause is None:
+        return None
+    openai = sys.modules['openai']
+    if isinstance(cause, openai.RateLimitError):
+        return 'rate_limited'
+    if isinstance(cause, (openai.APITimeoutError, openai.APIConnectionError)):
+        return 'connection'
+    if isinstance(cause, openai.APIStatusError) and cause.status_code >= 500:
+        return 'server_error'
+    return None
+
+
+class ModelLimiter:
+    '''
+    Client-side limits for one model: token buckets for requests and estimated
+    tokens per minute, an adaptive concurrency limit, and retries with jittered
+    exponential backoff that honour the provider's Retry-After.
+    '''
+    def __init__(self, model: str, rpm: float, tpm: float, max_concurrency: int = 64, initial_concurrency: int = 8,
+                 max_retries: int = 5, backoff_base: float = 0.5, backoff_cap: float = 30.0, burst_seconds: float = 1.0):
+        self.model = model
+        # buckets hold `burst_seconds` worth of the per-minute limit, so a cold start can't fire a whole minute at once
+        self.requests = TokenBucket(rpm / 60, max(1, rpm / 60 * burst_seconds))
+        self.tokens = TokenBucket(tpm / 60, max(1, tpm / 60 * burst_seconds))
+        self.concurrency = AdaptiveConcurrency(min(initial_concurrency, max_concurrency), maximum=max_concurrency)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+
+    def _reserve(self, tokens: int) -> float:
+        return max(self.requests.reserve(1), self.tokens.reserve(tokens))
+
+    def backoff(self, exc, attempt: int) -> float:
+        delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+        requested = retry_after(_root_cause(exc))
+        if requested is not None:
+            # never earlier than asked, plus a little jitter so waiters don't all return at once
+            delay = requested + random.uniform(0, self.backoff_base)
+        return delay
+
+    def _should_retry(self, exc, attempt: int):
+        reason = classify(exc)
+        if reason is None or attempt >= self.max_retries:
+            return None
+        if reason == 'rate_limited':
+            self.concurrency.on_overload()
+            llm_concurrency_limit.set(self.concurrency.limit, model=self.model)
+        llm_retries.inc(model=self.model, reason=reason)
+        delay = self.backoff(exc, attempt)
+        logger.debug(f"{self.model} request failed ({reason}), retry {attempt + 1} in {delay:.2f}s")
+        return delay
+
+    async def acall(self, request, tokens: int, keep_slot: bool = False):
+        '''
+        Await `request()` within the limits, retrying what's retryable. With
+        keep_slot=True the concurrency slot stays taken after success (e.g. while
+        a stream is read) and the caller must call `release()`.
+        '''
+        for attempt in range(self.max_retries + 1):
+            start = time.monotonic()
+            await self.concurrency.acquire()
+            try:
+                wait = self._reserve(tokens)
+                if wait:
+                    await asyncio.sleep(wait)
+                llm_rate_limit_wait_seconds.observe(time.monotonic() - start, model=self.model)
+                result = await request()
+            except BaseException as e:
+                self.concurrency.release()
+                delay = self._should_retry(e, attempt) if isinstance(e, Exception) else None
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            self.concurrency.on_success()
+            llm_concurrency_limit.set(self.concurrency.limit, model=self.model)
+            if not keep_slot:
+                self.concurrency.release()
+            return result
+
+    def call(self, request, tokens: int, keep_slot: bool = False):
+        '''Blocking acall, for the sync client'''
+        for attempt in range(self.max_retries + 1):
+            start = time.monotonic()
+            self.concurrency.acquire_sync()
+            try:
+                wait = self._reserve(tokens)
+                if wait:
+                    time.sleep(wait)
+                llm_rate_limit_wait_seconds.observe(time.monotonic() - start, model=self.model)
+                result = request()
+            except BaseException as e:
+                self.concurrency.release()
+                delay = self._should_retry(e, attempt) if isinstance(e, Exception) else None
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            self.concurrency.on_success()
+            llm_concurrency_limit.set(self.concurrency.limit, model=self.model)
+            if not keep_slot:
+                self.concurrency.release()
+            return result
+
+    def release(self):
+        self.concurrency.release()
+
+
+class RateLimiter:
+    '''
+    Per-model ModelLimiters, created on first use. `limits` maps a model name to
+    {"rpm": ..., "tpm": ..., "max_concurrency": ..., "burst_seconds": ...}; models not
+    listed get the defaults.
+    '''
+    def __init__(self, limits=None, default_rpm: float = 500, default_tpm: float = 200_000,
+                 max_concurrency: int = 64, initial_concurrency: int = 8, max_retries: int = 5,
+                 expected_output_tokens: int = 500):
+        self.limits = limits or {}
+        self.default_rpm = default_rpm
+        self.default_tpm = default_tpm
+        self.max_concurrency = max_concurrency
+        self.initial_concurrency = initial_concurrency
+        self.max_retries = max_retries
+        self.expected_output_tokens = expected_output_tokens
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def for_model(self, model: str) -> ModelLimiter:
+        with self._lock:
+            limiter = self._models.get(model)
+            if limiter is None:
+                config = self.limits.get(model, {})
+                limiter = self._models[model] = ModelLimiter(
+                    model,
+                    rpm=config.get('rpm', self.default_rpm),
+                    tpm=config.get('tpm', self.default_tpm),
+                    max_concurrency=config.get('max_concurrency', self.max_concurrency),
+                    initial_concurrency=self.initial_concurrency,
+                    max_retries=self.max_retries,
+                    burst_seconds=config.get('burst_seconds', 1.0),
+                )
+            return limiter
+
+    def estimate_tokens(self, messages) -> int:
+        '''Rough prompt size (4 characters a token) plus the expected completion'''
+        return sum(len(m['content']) for m in messages) // 4 + self.expected_output_tokens
+
+    def stats(self):
+        return {
+            model: {'concurrency_limit': round(limiter.concurrency.limit, 2), 'in_flight': limiter.concurrency.in_flight}
+            for model, limiter in self._models.items()
+        }
+
+
+rate_limiter = RateLimiter(
+    limits=json.loads(os.getenv("LLM_RATE_LIMITS", "{}")),
+    default_rpm=float(os.getenv("LLM_DEFAULT_RPM", 500)),
+    default_tpm=float(os.getenv("LLM_DEFAULT_TPM", 200_000)),
+    max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", 64)),
+    initial_concurrency=int(os.getenv("LLM_INITIAL_CONCURRENCY", 8)),
+    max_retries=int(os.getenv("LLM_MAX_RETRIES", 5)),
+)
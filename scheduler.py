@@ -0,0 +1,125 @@
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+
+from metrics import registry, queue_wait_seconds
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class GenerationScheduler:
+    '''
+    Runs generation jobs on a fixed number of worker tasks fed by a bounded queue.
+    Submissions beyond the queue size are rejected straight away instead of piling
+    up more in-flight LLM calls than the process can handle. Cancelled jobs leave
+    the queue at once, so they never take up room.
+    '''
+    def __init__(self, num_workers: int = 4, max_queue_size: int = 64):
+        self.num_workers = num_workers
+        self.max_queue_size = max_queue_size
+        self._workers = []
+        # the queue: call_ids waiting for a worker -> (when they were queued, job, args, kwargs), in submission order
+        self._pending = OrderedDict()
+        # set when a job is queued; workers that find the queue empty clear it and wait
+        self._ready = None
+        # call_id -> task running its job
+        self._running = {}
+        # callbacks run with the call_id a worker just picked up, e.g. to push new queue positions
+        self._listeners = []
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def _ensure_started(self):
+        if self._workers:
+            return
+        self._ready = asyncio.Event()
+        self._workers = [
+            asyncio.create_task(self._worker(i)) for i in range(self.num_workers)
+        ]
+        logger.debug(f"Started {self.num_workers} generation workers, queue size {self.max_queue_size}")
+
+    def submit(self, call_id: str, job, *args, **kwargs):
+        '''
+        Queue `job(*args, **kwargs)` (a coroutine function) to run on a worker.
+        Returns the 1-based queue position, raises QueueFullError if the queue is full.
+        '''
+        self._ensure_started()
+        if len(self._pending) >= self.max_queue_size:
+            raise QueueFullError(f"Generation queue is full ({self.max_queue_size} pending)")
+        self._pending[call_id] = (time.monotonic(), job, args, kwargs)
+        self._ready.set()
+        return len(self._pending)
+
+    def queue_position(self, call_id: str):
+        '''1-based position of call_id in the queue, or None if it isn't waiting.'''
+        for position, pending_id in enumerate(self._pending, start=1):
+            if pending_id == call_id:
+                return position
+        return None
+
+    @property
+    def queue_size(self):
+        return len(self._pending)
+
+    def pending_call_ids(self):
+        return list(self._pending)
+
+    def cancel(self, call_id: str):
+        '''
+        Cancel call_id's job: a queued one is dropped from the queue, a running
+        one gets CancelledError at its next await. Returns False if there was
+        nothing to cancel.
+        '''
+        if self._pending.pop(call_id, None) is not None:
+            logger.debug(f"Dropped queued call_id: {call_id}")
+            return True
+        task = self._running.get(call_id)
+        if task is None:
+            return False
+        task.cancel()
+        logger.debug(f"Cancelling running call_id: {call_id}")
+        return True
+
+    async def _worker(self, worker_id: int):
+        while True:
+            while not self._pending:
+                self._ready.clear()
+                await self._ready.wait()
+            call_id, (queued_at, job, args, kwargs) = self._pending.popitem(last=False)
+            queue_wait_seconds.observe(time.monotonic() - queued_at)
+            logger.debug(f"Worker {worker_id} picked up call_id: {call_id}")
+            for listener in self._listeners:
+                listener(call_id)
+            # its own task, so cancelling one job doesn't take the worker down with it
+            task = self._running[call_id] = asyncio.create_task(job(*args, **kwargs))
+            try:
+                await asyncio.wait([task])
+                if task.cancelled():
+                    logger.debug(f"Generation cancelled for call_id: {call_id}")
+                elif task.exception() is not None:
+                    logger.error(f"Generation failed for call_id: {call_id}", exc_info=task.exception())
+            finally:
+                self._running.pop(call_id, None)
+                # only does anything when the worker itself is being shut down
+                task.cancel()
+
+    async def shutdown(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+
+scheduler = GenerationScheduler(
+    num_workers=int(os.getenv("GENERATION_WORKERS", 4)),
+    max_queue_size=int(os.getenv("GENERATION_QUEUE_SIZE", 64)),
+)
+
+registry.gauge('prompt_battle_queue_depth', "Battles waiting for a generation worker", fn=lambda: scheduler.queue_size)
@@ -0,0 +1,93 @@
+import json
+import hashlib
+import logging
+import threading
+import unicodedata
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_task(task: str) -> str:
+    return ' '.join(unicodedata.normalize('NFC', task).split())
+
+
+class Flight:
+    def __init__(self, key: str, leader_id: str, session_id):
+        self.key = key
+        self.leader_id = leader_id
+        self.members = {leader_id: session_id}  # call_id -> session_id
+        # stage -> (stage_input, output) for stages already finished, replayed to late joiners
+        self.completed = {}
+
+
+class SingleFlight:
+    '''
+    De-duplicates identical in-flight battles. The first submission for a key
+    becomes the leader and actually runs; identical submissions made while it is
+    running join as members and get every stage result under their own call_id.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_key = {}
+        self._by_call_id = {}
+
+    @staticmethod
+    def make_key(task: str, config) -> str:
+        payload = json.dumps([normalize_task(task), config], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def join(self, key: str, call_id: str, session_id):
+        '''Returns (flight, is_leader)'''
+        with self._lock:
+            flight = self._by_key.get(key)
+            if flight is None:
+                flight = Flight(key, call_id, session_id)
+                self._by_key[key] = flight
+                self._by_call_id[call_id] = flight
+                return flight, True
+            flight.members[call_id] = session_id
+            self._by_call_id[call_id] = flight
+            logger.debug(f"call_id {call_id} joined in-flight battle {flight.leader_id}")
+            return flight, False
+
+    def members(self, call_id: str, session_id=None):
+        '''(call_id, session_id) pairs sharing call_id's flight, or just call_id itself'''
+        with self._lock:
+            flight = self._by_call_id.get(call_id)
+            if flight is None:
+                return [(call_id, session_id)]
+            return list(flight.members.items())
+
+    def record(self, call_id: str, stage: str, stage_input, output):
+        with self._lock:
+            flight = self._by_call_id.get(call_id)
+            if flight is not None:
+                flight.completed[stage] = (stage_input, output)
+
+    def leave(self, call_id: str):
+        '''
+        Stop fanning results out to call_id. Returns (flight, members left), or
+        (None, 0) if call_id isn't in a flight. The leader stays reachable by its
+        call_id, since that's what the running battle reports stages under.
+        '''
+        with self._lock:
+            flight = self._by_call_id.get(call_id)
+            if flight is None or call_id not in flight.members:
+                return None, 0
+            del flight.members[call_id]
+            if call_id != flight.leader_id:
+                del self._by_call_id[call_id]
+            return flight, len(flight.members)
+
+    def finish(self, key: str, leader_id: str = None):
+        '''Forget the flight for key; with leader_id, only if it's still that leader's flight'''
+        with self._lock:
+            flight = self._by_key.get(key)
+            if flight is None or (leader_id is not None and flight.leader_id != leader_id):
+                return
+            del self._by_key[key]
+            for call_id in (*flight.members, flight.leader_id):
+                self._by_call_id.pop(call_id, None)
+
+
+single_flight = SingleFlight()
@@ -0,0 +1,338 @@
+import os
+import json
+import time
+import atexit
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+from fastlite import Database
+
+from batch_writer import BatchWriter
+from metrics import db_write_batch_seconds, db_writes
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = os.getenv("PROMPT_BATTLE_DB", "prompt_battle2.db")
+
+
+class Storage:
+    '''
+    SQLite in WAL mode with one writer and many readers.
+
+    Every write is queued with `write(fn, *args)` and run as `fn(db, *args)` on a
+    single writer thread, which commits everything queued in one transaction
+    (each write in its own savepoint, so one bad row doesn't sink the batch).
+    Reads go through `reader`, a separate connection per thread, and never wait
+    on the writer. Queued writes are flushed on `close()`, which also runs at exit.
+    '''
+    def __init__(self, path: str = DB_PATH, batch_size: int = 500, max_delay: float = 0.01):
+        self.path = path
+        self.db = Database(path)
+        self._configure(self.db)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self._local = threading.local()
+        self.writer = BatchWriter(self._write_batch, batch_size=batch_size, max_delay=max_delay, name='db-writer')
+        atexit.register(self.close)
+
+    @staticmethod
+    def _configure(db):
+        db.execute("PRAGMA busy_timeout=5000")
+        db.execute("PRAGMA synchronous=NORMAL")
+
+    @property
+    def reader(self):
+        '''This thread's read connection'''
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = Database(self.path)
+            self._configure(db)
+            db.execute("PRAGMA query_only=1")
+            self._local.db = db
+        return db
+
+    def write(self, fn, *args):
+        self.writer.put((fn, args))
+
+    def insert(self, table: str, row: dict):
+        self.writer.put((_insert, (table, row)))
+
+    def _write_batch(self, ops):
+        start = time.perf_counter()
+        with self.db.conn:
+            for fn, args in _group_inserts(ops):
+                try:
+                    with self.db.conn:
+                        fn(self.db, *args)
+                except Exception:
+                    if fn is not _insert_all:
+                        logger.exception(f"Write {getattr(fn, '__name__', fn)} failed")
+                        continue
+                    # retry the group row by row so only the bad rows are lost
+                    table, rows = args
+                    for row in rows:
+                        try:
+                            with self.db.conn:
+                                _insert(self.db, table, row)
+                        except Exception:
+                            logger.exception(f"Insert into {table} failed")
+        db_write_batch_seconds.observe(time.perf_counter() - start)
+        db_writes.inc(len(ops))
+        logger.debug(f"Committed {len(ops)} writes")
+
+    def flush(self, timeout: float = None):
+        self.writer.flush(timeout)
+
+    def close(self):
+        self.writer.close()
+
+
+def _insert(db, table: str, row: dict):
+    db[table].insert(row)
+
+
+def _insert_all(db, table: str, rows: list):
+    db[table].insert_all(rows)
+
+
+def _group_inserts(ops):
+    '''Merge runs of inserts into the same table into one insert_all, keeping write order'''
+    grouped = []
+    for fn, args in ops:
+        if fn is _insert:
+            table, row = args
+            if grouped and grouped[-1][0] is _insert_all and grouped[-1][1][0] == table:
+                grouped[-1][1][1].append(row)
+            else:
+                grouped.append((_insert_all, (table, [row])))
+        else:
+            grouped.append((fn, args))
+    return grouped
+
+
+storage = Storage()
+db = storage.db
+
+
+class Generation:
+    call_id: str;
+    session_id: str;
+    call_type: str;
+    input:str;
+    output: str;
+    timestamp: datetime;
+
+generations_tbl = db['generation']
+
+# One row per battle: the contenders it was run with, and `outputs`, a JSON
+# object of {stage: {"output", "at"}} filled in as stages finish. Generation
+# keeps the per-stage log, this is what status checks read. The per-stage
+# columns are only set on battles from before contenders were configurable.
+class Battle:
+    battle_id: str;
+    session_id: str;
+    task: str;
+    status: str;
+    contenders: str;
+    outputs: str;
+    o1_prompt: str;
+    challenger_prompt: str;
+    o1_output: str;
+    challenger_output: str;
+    o1_prompt_at: str;
+    challenger_prompt_at: str;
+    o1_output_at: str;
+    challenger_output_at: str;
+    created_at: str;
+    last_seen_at: float;
+
+BATTLE_STAGES = ('o1_prompt', 'challenger_prompt', 'o1_output', 'challenger_output')
+
+battles_tbl = db['battle']
+
+class Grade:
+    grade_id: str;
+    session_id: str;
+    call_id: str;
+    grade: str;
+    contender_a: str;
+    contender_b: str;
+    timestamp: datetime;
+
+grades_tbl = db['grade']
+
+
+@contextmanager
+def schema_transaction():
+    '''
+    Hold SQLite's write lock for the block, so worker processes starting
+    together don't race to create the same tables. Nests.
+    '''
+    if db.conn.in_transaction:
+        yield
+        return
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+    db.execute("COMMIT")
+
+
+def setup_schema():
+    '''
+    Create or update the tables and indexes, and backfill battle rows for older
+    databases. Run once at startup (not at import, so reloads and tools that
+    only import this module stay fast); safe to re-run.
+    '''
+    with schema_transaction():
+        _create_tables()
+
+
+def _create_tables():
+    generations = db.create(Generation, pk='call_id', transform=True)
+    generations.create_index(['session_id'], if_not_exists=True)
+    generations.create_index(['call_type'], if_not_exists=True)
+    # keyset pagination for export.py
+    generations.create_index(['timestamp', 'call_id'], if_not_exists=True)
+
+    battles = db.create(Battle, pk='battle_id', transform=True)
+    battles.create_index(['session_id', 'created_at'], if_not_exists=True)
+    battles.create_index(['status'], if_not_exists=True)
+
+    grades = db.create(Grade, pk='grade_id', transform=True)
+    grades.create_index(['session_id'], if_not_exists=True)
+    grades.create_index(['call_id'], if_not_exists=True)
+    grades.create_index(['timestamp'], if_not_exists=True)
+
+    if not db.q("SELECT 1 FROM battle LIMIT 1"):
+        migrate_generations_to_battles()
+
+
+def insert_generation(row: dict):
+    storage.insert(generations_tbl.name, row)
+
+
+def insert_grade(row: dict):
+    storage.insert(grades_tbl.name, row)
+
+
+def create_battle(battle_id: str, session_id: str, task: str, contenders):
+    storage.insert(battles_tbl.name, dict(
+        battle_id=battle_id,
+        session_id=session_id,
+        task=task,
+        status='queued',
+        contenders=json.dumps(list(contenders)),
+        outputs='{}',
+        created_at=datetime.now().isoformat(),
+    ))
+
+
+def _update_battle_stage(db, battle_id: str, stage: str, output: str, timestamp: str):
+    # Writes run one at a time on the writer thread, so reading the outputs back first doesn't race
+    rows = db.q("SELECT contenders, outputs FROM battle WHERE battle_id = ?", [battle_id])
+    if not rows:
+        return
+    outputs = json.loads(rows[0]['outputs'] or '{}')
+    outputs[stage] = {'output': output, 'at': timestamp}
+    contenders = json.loads(rows[0]['contenders'] or '[]')
+    complete = bool(contenders) and all(f'{name}_output' in outputs for name in contenders)
+    db.execute(
+        "UPDATE battle SET outputs = ?, "
+        "status = CASE WHEN status = 'cancelled' THEN status ELSE ? END "
+        "WHERE battle_id = ?",
+        [json.dumps(outputs), 'complete' if complete else 'running', battle_id],
+    )
+
+
+def update_battle_stage(battle_id: str, stage: str, output: str, timestamp: str):
+    storage.write(_update_battle_stage, battle_id, stage, output, timestamp)
+
+
+def _fail_battle(db, battle_id: str):
+    db.execute("UPDATE battle SET status = 'failed' WHERE battle_id = ?", [battle_id])
+
+
+def fail_battle(battle_id: str):
+    storage.write(_fail_battle, battle_id)
+
+
+def _cancel_battle(db, battle_id: str):
+    db.execute("UPDATE battle SET status = 'cancelled' WHERE battle_id = ? AND status IN ('queued', 'running')", [battle_id])
+
+
+def cancel_battle(battle_id: str):
+    '''Mark a battle nobody is waiting for any more as cancelled, unless it already finished'''
+    storage.write(_cancel_battle, battle_id)
+
+
+def _reset_battle(db, battle_id: str):
+    db.execute("DELETE FROM battle WHERE battle_id = ?", [battle_id])
+    # every `{battle_id}-{stage}` key sorts between `{battle_id}-` and `{battle_id}.`, so this uses the pk index
+    db.execute("DELETE FROM generation WHERE call_id > ? AND call_id < ?", [f"{battle_id}-", f"{battle_id}."])
+
+
+def reset_battle(battle_id: str):
+    '''Drop a battle and its generation rows so it can be run again under the same id'''
+    storage.write(_reset_battle, battle_id)
+
+
+def get_completed_battle_ids():
+    return {row['battle_id'] for row in storage.reader.q("SELECT battle_id FROM battle WHERE status = 'complete'")}
+
+
+def battle_outputs(battle: dict):
+    '''{stage: output} for the stages of a battle row that finished'''
+    if battle.get('outputs') is not None:
+        return {stage: value['output'] for stage, value in json.loads(battle['outputs']).items()}
+    return {stage: battle[stage] for stage in BATTLE_STAGES if battle.get(stage) is not None}
+
+
+def battle_contenders(battle: dict):
+    '''Names of the contenders a battle row was run with, or None for battles from before they were recorded'''
+    return json.loads(battle['contenders']) if battle.get('contenders') else None
+
+
+def get_battle(battle_id: str):
+    '''The battle row as a dict, or None'''
+    rows = storage.reader.q("SELECT * FROM battle WHERE battle_id = ?", [battle_id])
+    return rows[0] if rows else None
+
+
+def get_session_battles(session_id: str, limit: int = 50):
+    '''Most recent battles for a session, newest first (uses the session_id/created_at index)'''
+    return storage.reader.q(
+        "SELECT * FROM battle WHERE session_id = ? ORDER BY created_at DESC LIMIT ?",
+        [session_id, limit],
+    )
+
+
+def migrate_generations_to_battles():
+    '''
+    Backfill battle rows from the per-stage generation rows of older databases,
+    where each stage was stored as `{call_id}-{stage}`. Battles missing an
+    output never finish now, so they're backfilled as failed. Safe to re-run.
+    '''
+    stage_columns = ', '.join(
+        f"max(CASE WHEN call_type = '{stage}' THEN output END), "
+        f"max(CASE WHEN call_type = '{stage}' THEN timestamp END)"
+        for stage in BATTLE_STAGES
+    )
+    column_names = ', '.join(f"{stage}, {stage}_at" for stage in BATTLE_STAGES)
+    with db.conn:
+        db.execute(f"""
+            INSERT OR IGNORE INTO battle (battle_id, session_id, task, created_at, {column_names}, status)
+            SELECT battle_id, max(session_id),
+                   max(CASE WHEN call_type IN ('o1_prompt', 'challenger_prompt') THEN input END),
+                   min(timestamp), {stage_columns},
+                   CASE WHEN sum(call_type IN ('o1_output', 'challenger_output')) = 2 THEN 'complete' ELSE 'failed' END
+            FROM (
+                SELECT substr(call_id, 1, length(call_id) - length(call_type) - 1) AS battle_id, *
+                FROM generation
+                WHERE call_type IN ({', '.join(f"'{stage}'" for stage in BATTLE_STAGES)})
+            )
+            GROUP BY battle_id
+        """)
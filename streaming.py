@@ -0,0 +1,20 @@
+import time
+
+
+async def coalesce_chunks(chunks, interval: float = 0.05):
+    '''
+    Merge small text deltas from an async iterator so consumers get at most
+    one chunk per `interval` seconds. The first delta is passed through straight
+    away to keep time-to-first-token low, and anything buffered is flushed at the end.
+    '''
+    buffer = []
+    last_flush = None
+    async for chunk in chunks:
+        buffer.append(chunk)
+        now = time.monotonic()
+        if last_flush is None or now - last_flush >= interval:
+            yield ''.join(buffer)
+            buffer = []
+            last_flush = now
+    if buffer:
+        yield ''.join(buffer)